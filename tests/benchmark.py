@@ -0,0 +1,229 @@
+"""
+Benchmark of the hot path: loads the recorded posts through RedditLoader and renders the replies into a Telegram sink,
+with the upstreams served by the local stand-ins.
+
+    python tests/benchmark.py --requests 500 --concurrency 16 > bench_output.txt
+
+Every scenario runs in a process of its own, so that the peak RSS is the scenario's own.
+The results are printed as JSON, to be compared between commits
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "unreddit"))
+
+os.environ.setdefault("REDDIT_USER_AGENT", "benchmark")
+os.environ.setdefault("IMGUR_CLIENT_ID", "benchmark")
+# The sink is not subject to the flood control, so the replies are not paced unless asked to
+os.environ.setdefault("SEND_RATE", "0")
+os.environ.setdefault("CHAT_SEND_RATE", "0")
+
+from aiogram import Bot
+from aiogram.types import Message
+from aiohttp.test_utils import TestServer
+
+from loaders import RedditLoader
+from loaders.imgur import IMGUR_API_URL_KEY
+from loaders.loader import MEDIA_CACHE, NEGATIVE_CACHE
+from loaders.reddit import REDDIT_API_URL_KEY, REDDIT_CACHE, SHARE_CACHE
+from reply import FILE_ID_CACHE, Reply
+from upstreams import SHARE_MAP, SinkBot, make_imgur_app, make_reddit_app
+
+SCENARIOS = {
+    "image": "https://www.reddit.com/r/ProperAnimalNames/comments/eakgxt/caaterpillar/",
+    "gallery": "https://www.reddit.com/r/masseffect/comments/ioubvj/for_13_year_old_game_it_sure_is_stunning_visuals/",
+    "video": "https://www.reddit.com/r/aww/comments/eafg2x/%CA%B8%E1%B5%83%CA%B7%E2%81%BF/",
+    "comment": "https://www.reddit.com/r/ShitpostXIV/comments/1hl0gyj/breaking_news_in_response_to_the_people/m3ij6ht/",
+    "crosspost": "https://www.reddit.com/r/badukshitposting/comments/1hbq2co/how_the_heck_am_i_supposed_to_play_this/",
+    "imgur_album": "https://www.reddit.com/r/firebrigade/comments/dxhrr1/fire_forces_princess_hibana_wallpaper_series/",
+    "share_link": "https://www.reddit.com/r/badukshitposting/s/auJDBZLHYO/",
+}
+
+SHARE_MAP["auJDBZLHYO"] = SCENARIOS["crosspost"]
+
+
+def _clear_caches() -> None:
+    REDDIT_CACHE.memory.clear()
+    SHARE_CACHE.memory.clear()
+    MEDIA_CACHE.memory.clear()
+    NEGATIVE_CACHE.clear()
+    FILE_ID_CACHE.clear()
+
+
+def _get_message(url: str, message_id: int) -> Message:
+    return Message.to_object({
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": 1, "type": "private"},
+        "from": {"id": 1, "is_bot": False, "first_name": "Benchmark"},
+        "text": url,
+    })
+
+
+def percentile(latencies: List[float], percent: float) -> float:
+    # Nearest rank of the sorted latencies
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+
+def get_peak_rss() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _drive(bot: Bot, url: str, requests: int, concurrency: int, warm: bool) -> Dict:
+    latencies = []
+    errors = 0
+    pending = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+
+        for message_id in pending:
+            if not warm:
+                _clear_caches()
+
+            started = time.perf_counter()
+
+            try:
+                content, metadata = await RedditLoader(bot.session).load(url)
+                await Reply(_get_message(url, message_id), content, metadata).send()
+
+            except Exception as e:
+                errors += 1
+                logging.getLogger().debug("Benchmark request has failed", exc_info=e)
+                continue
+
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    return {"latencies": sorted(latencies), "errors": errors, "elapsed": elapsed}
+
+
+async def _run_scenario(name: str, options: argparse.Namespace) -> Dict:
+    reddit_server = TestServer(make_reddit_app())
+    imgur_server = TestServer(make_imgur_app())
+    await reddit_server.start_server()
+    await imgur_server.start_server()
+
+    os.environ[REDDIT_API_URL_KEY] = f"{reddit_server.make_url('')}"
+    os.environ[IMGUR_API_URL_KEY] = f"{imgur_server.make_url('')}"
+
+    bot = SinkBot()
+    Bot.set_current(bot)
+    url = SCENARIOS[name]
+
+    try:
+        await _drive(bot, url, options.warmup, options.concurrency, options.warm)
+
+        run = await _drive(bot, url, options.requests, options.concurrency, options.warm)
+
+        # Tracing slows everything down, so the allocations are measured in a separate run
+        tracemalloc.start()
+        await _drive(bot, url, options.allocation_requests, options.concurrency, options.warm)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    finally:
+        await bot.close()
+        await reddit_server.close()
+        await imgur_server.close()
+
+    latencies = run["latencies"]
+
+    return {
+        "requests": options.requests,
+        "errors": run["errors"],
+        "throughput": len(latencies) / run["elapsed"],
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1],
+        } if latencies else None,
+        "allocations": {
+            "requests": options.allocation_requests,
+            "peak_bytes": peak,
+            "retained_bytes": retained,
+        },
+        "peak_rss_bytes": get_peak_rss(),
+        "telegram_calls": dict(bot.calls),
+    }
+
+
+def run_scenario(name: str, options: argparse.Namespace) -> Dict:
+    logging.basicConfig(level=logging.WARNING)
+    return asyncio.run(_run_scenario(name, options))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="Scenario to run, all of them by default (can be repeated)")
+    parser.add_argument("--requests", type=int, default=200, help="Measured requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in progress at the same time")
+    parser.add_argument("--warmup", type=int, default=20, help="Unmeasured requests made first")
+    parser.add_argument("--allocation-requests", type=int, default=50,
+                        help="Requests made with the allocations traced")
+    parser.add_argument("--warm", action="store_true",
+                        help="Keep the caches between the requests instead of loading every post from the upstream")
+    parser.add_argument("--output", help="File to write the results to instead of stdout")
+    options = parser.parse_args()
+
+    results = {}
+
+    for name in options.scenario or SCENARIOS:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+            results[name] = executor.submit(run_scenario, name, options).result()
+
+    report = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": {
+            "requests": options.requests,
+            "concurrency": options.concurrency,
+            "warmup": options.warmup,
+            "allocation_requests": options.allocation_requests,
+            "warm": options.warm,
+        },
+        "scenarios": results,
+    }
+
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""
+Load generator: feeds synthetic updates through the Dispatcher of main(), with the upstreams served by the local
+stand-ins and Telegram by a sink, at a rate ramped up stage by stage until the bot saturates.
+
+    python tests/loadgen.py --start-rate 20 --max-rate 2000 --latency 0.2 --error-rate 0.01
+
+A stage is saturated when the bot handles less than `--saturation-ratio` of the rate offered to it, which is when
+the backlog of the updates in progress starts to grow, or when the event loop lags more than `--max-lag`.
+The report is printed as JSON
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from itertools import count
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "unreddit"))
+
+os.environ.setdefault("REDDIT_USER_AGENT", "loadgen")
+os.environ.setdefault("IMGUR_CLIENT_ID", "loadgen")
+# The sink is not subject to the flood control, so the replies are not paced unless asked to
+os.environ.setdefault("SEND_RATE", "0")
+os.environ.setdefault("CHAT_SEND_RATE", "0")
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp.test_utils import TestServer
+
+from benchmark import SCENARIOS, get_commit, get_peak_rss, percentile
+from loaders.imgur import IMGUR_API_URL_KEY
+from loaders.reddit import REDDIT_API_URL_KEY
+from main import create_dispatcher, on_shutdown, on_startup
+from upstreams import SinkBot, faults, make_imgur_app, make_reddit_app
+
+LAG_INTERVAL = 0.01
+SUBREDDITS = ("aww", "formula1", "masseffect", "ProperAnimalNames")
+
+# Posts whose ids can be varied to make distinct posts, see upstreams.find_response
+POSTS = ("image", "gallery", "video", "crosspost", "imgur_album")
+
+
+def _get_latency(distribution: str, mean: float) -> Optional[Callable[[], float]]:
+    if not mean:
+        return None
+
+    if distribution == "uniform":
+        return lambda: random.uniform(0, 2 * mean)
+
+    elif distribution == "exponential":
+        return lambda: random.expovariate(1 / mean)
+
+    return lambda: mean
+
+
+def _summarize(values: List[float]) -> Optional[Dict[str, float]]:
+    if not values:
+        return None
+
+    values = sorted(values)
+
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": values[-1],
+    }
+
+
+class Stage:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.sent = 0
+        self.handled = 0
+        self.errors = 0
+        self.latencies: List[float] = []
+        self.lags: List[float] = []
+        self.queue_start = 0
+        self.queue_end = 0
+        self.queue_max = 0
+
+    def report(self, duration: float) -> Dict:
+        return {
+            "offered_rate": self.rate,
+            "sent": self.sent,
+            "handled": self.handled,
+            "throughput": self.handled / duration,
+            "errors": self.errors,
+            "latency": _summarize(self.latencies),
+            "queue": {"start": self.queue_start, "end": self.queue_end, "max": self.queue_max},
+            "loop_lag": _summarize(self.lags),
+        }
+
+
+class LoadGenerator:
+    def __init__(self, dp: Dispatcher, options: argparse.Namespace):
+        self.dp = dp
+        self.options = options
+        self.in_flight = 0
+        self.stage: Optional[Stage] = None
+
+        self.__ids = count(1)
+        self.__tasks = set()
+
+    def get_update(self) -> Update:
+        update_id = next(self.__ids)
+        user = {"id": update_id % 1000 + 1, "is_bot": False, "first_name": "Load"}
+        kind = random.random()
+
+        if kind < self.options.unr_share:
+            return Update.to_object({"update_id": update_id, "message": {
+                "message_id": update_id, "date": int(time.time()), "from": user,
+                "chat": {"id": user["id"], "type": "private"},
+                "text": f"have a look at r/{random.choice(SUBREDDITS)}",
+            }})
+
+        url = self.get_url(update_id)
+
+        if kind < self.options.unr_share + self.options.inline_share:
+            return Update.to_object({"update_id": update_id, "inline_query": {
+                "id": str(update_id), "from": user, "query": url, "offset": "",
+            }})
+
+        return Update.to_object({"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()), "from": user,
+            "chat": {"id": user["id"], "type": "private"},
+            "text": url,
+        }})
+
+    def get_url(self, update_id: int) -> str:
+        if random.random() < self.options.repeat_rate:
+            return SCENARIOS[random.choice(list(SCENARIOS))]
+
+        # A post nobody has linked to yet, which is in none of the caches
+        scenario = SCENARIOS[random.choice(POSTS)]
+        head, rest = scenario.split("/comments/")
+        post_id, tail = rest.split("/", 1)
+        return f"{head}/comments/{post_id}{update_id:x}/{tail}"
+
+    def send(self) -> None:
+        stage = self.stage
+        stage.sent += 1
+        self.in_flight += 1
+        stage.queue_max = max(stage.queue_max, self.in_flight)
+
+        task = asyncio.ensure_future(self.handle(stage, self.get_update()))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def handle(self, stage: Stage, update: Update) -> None:
+        started = time.perf_counter()
+
+        try:
+            await self.dp.process_update(update)
+
+        except Exception as e:
+            stage.errors += 1
+            logging.getLogger().debug("Update has failed", exc_info=e)
+
+        finally:
+            self.in_flight -= 1
+
+        if self.stage is not None:
+            self.stage.handled += 1
+
+        stage.latencies.append(time.perf_counter() - started)
+
+    async def run_stage(self, stage: Stage) -> None:
+        self.stage = stage
+        stage.queue_start = self.in_flight
+
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        interval = 1 / stage.rate
+
+        # Open loop: the updates keep coming at the offered rate however slow the bot is
+        for sent in count():
+            scheduled = started + sent * interval
+
+            if scheduled - started >= self.options.stage_duration:
+                break
+
+            delay = scheduled - loop.time()
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self.send()
+
+        await asyncio.sleep(max(0.0, started + self.options.stage_duration - loop.time()))
+        stage.queue_end = self.in_flight
+
+    async def measure_lag(self) -> None:
+        loop = asyncio.get_event_loop()
+
+        while True:
+            started = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+
+            if self.stage is not None:
+                self.stage.lags.append(loop.time() - started - LAG_INTERVAL)
+
+    async def drain(self) -> None:
+        if self.__tasks:
+            await asyncio.wait(self.__tasks, timeout=self.options.drain_timeout)
+
+    def is_saturated(self, stage: Stage) -> bool:
+        lag = _summarize(stage.lags)
+
+        return stage.handled < stage.sent * self.options.saturation_ratio or \
+            (lag is not None and lag["p99"] > self.options.max_lag)
+
+
+async def _run(options: argparse.Namespace) -> Dict:
+    middlewares = [faults(_get_latency(options.latency_distribution, options.latency),
+                          options.error_rate, options.error_status or (503,))]
+
+    reddit_server = TestServer(make_reddit_app(middlewares))
+    imgur_server = TestServer(make_imgur_app(middlewares))
+    await reddit_server.start_server()
+    await imgur_server.start_server()
+
+    os.environ[REDDIT_API_URL_KEY] = f"{reddit_server.make_url('')}"
+    os.environ[IMGUR_API_URL_KEY] = f"{imgur_server.make_url('')}"
+
+    bot = SinkBot(latency=options.telegram_latency)
+    dp = create_dispatcher(bot)
+    Dispatcher.set_current(dp)
+    Bot.set_current(bot)
+
+    generator = LoadGenerator(dp, options)
+    stages = []
+    saturation = None
+
+    await on_startup(dp)
+    lag = asyncio.ensure_future(generator.measure_lag())
+
+    try:
+        rate = options.start_rate
+
+        while rate <= options.max_rate:
+            stage = Stage(rate)
+            await generator.run_stage(stage)
+            stages.append(stage)
+
+            if generator.is_saturated(stage):
+                saturation = rate
+                break
+
+            rate *= options.step
+
+        generator.stage = None
+        await generator.drain()
+
+    finally:
+        lag.cancel()
+        await on_shutdown(dp)
+        await bot.close()
+        await reddit_server.close()
+        await imgur_server.close()
+
+    sustained = [stage for stage in stages if stage.rate != saturation]
+
+    return {
+        "saturation_rate": saturation,
+        "sustained_throughput": max((stage.handled / options.stage_duration for stage in sustained), default=None),
+        "stages": [stage.report(options.stage_duration) for stage in stages],
+        "telegram_calls": dict(bot.calls),
+        "peak_rss_bytes": get_peak_rss(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--start-rate", type=float, default=20, help="Updates per second of the first stage")
+    parser.add_argument("--max-rate", type=float, default=2000, help="Updates per second to stop ramping at")
+    parser.add_argument("--step", type=float, default=1.5, help="Factor the rate is multiplied by every stage")
+    parser.add_argument("--stage-duration", type=float, default=10, help="Seconds every stage lasts")
+    parser.add_argument("--drain-timeout", type=float, default=30,
+                        help="Seconds to wait for the updates in progress after the last stage")
+    parser.add_argument("--inline-share", type=float, default=0.2, help="Share of the updates that are inline queries")
+    parser.add_argument("--unr-share", type=float, default=0.1,
+                        help="Share of the updates that are messages mentioning subreddits")
+    parser.add_argument("--repeat-rate", type=float, default=0.2,
+                        help="Share of the links to the recorded posts, the rest are to posts never seen before")
+    parser.add_argument("--latency", type=float, default=0.1, help="Mean seconds the upstreams take to respond")
+    parser.add_argument("--latency-distribution", choices=("constant", "uniform", "exponential"),
+                        default="exponential")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of the upstream responses that fail")
+    parser.add_argument("--error-status", type=int, action="append",
+                        help="Status of the failed upstream responses, 503 by default (can be repeated)")
+    parser.add_argument("--telegram-latency", type=float, default=0.05,
+                        help="Seconds every call to the Telegram API takes")
+    parser.add_argument("--saturation-ratio", type=float, default=0.9,
+                        help="Share of the updates of a stage that have to be handled within it")
+    parser.add_argument("--max-lag", type=float, default=0.1, help="Seconds the event loop may lag at p99")
+    parser.add_argument("--log-level", default="CRITICAL")
+    parser.add_argument("--output", help="File to write the results to instead of stdout")
+    options = parser.parse_args()
+
+    logging.basicConfig(level=options.log_level)
+
+    report = {
+        "commit": get_commit(),
+        "options": vars(options),
+        **asyncio.run(_run(options)),
+    }
+
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
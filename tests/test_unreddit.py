@@ -1,25 +1,53 @@
+import asyncio
 import json
 import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+from contextvars import ContextVar
+from functools import partial
 from itertools import zip_longest
-from typing import Dict, List
-from unittest.mock import Mock, AsyncMock
+from multiprocessing import get_context
+from pathlib import Path
+from typing import List, Optional
+from unittest.mock import Mock, AsyncMock, ANY
 from urllib.parse import unquote
 
 import pytest
-from aiogram import Bot
+from aiogram import Bot, Dispatcher
 from aiogram.types import Message, InputMedia, InlineKeyboardButton, InlineKeyboardMarkup
-from aiogram.utils.exceptions import BadRequest
-from aiohttp import web, ClientSession
-from aiohttp.web_request import Request
-from aiohttp.web_response import Response
+from aiogram.utils.exceptions import BadRequest, RetryAfter
+from aiohttp import ClientResponseError, ClientSession, web
 from pytest_aiohttp.plugin import aiohttp_server
 
+from batcher import Batcher
+from cache import LRUCache, TieredCache
+from content import Album, Animation, Button, Image, Link, Text, Video
+from content.serialization import StoredMetadata, dumps, loads
+from loaders import RedditLoader, get_loader
 from loaders.imgur import IMGUR_API_URL_KEY
-from loaders.reddit import REDDIT_API_URL_KEY
+from loaders.loader import (CONTENT_CACHE_PATH_KEY, MEDIA_CACHE, NEGATIVE_CACHE, NEGATIVE_CACHE_TTLS, NotModifiedError,
+                            _revalidating)
+from loaders.reddit import REDDIT_API_URL_KEY, REDDIT_CACHE, SHARE_CACHE, SHARE_CACHE_PATH_KEY
+from metrics import (LOAD_RESULTS, PREFLIGHT_RESULTS, SEND_FALLBACKS, STARTUP_SECONDS, UPSTREAM_RESPONSES,
+                     WORKER_RESTARTS, observe_startup, render)
+from preflight import PREFLIGHT_CACHE, PREFLIGHT_ERROR_CACHE_TTL_KEY, preflight
+from ratelimit import (INLINE_PRIORITY, MESSAGE_PRIORITY, REVALIDATION_PRIORITY, RateLimiter, get_priority,
+                       prioritized)
+from relay import RELAY_KEY, RELAY_SIZE_LIMIT_KEY, RELAY_SPOOL_SIZE_KEY
+from reply import FILE_ID_CACHE, Reply
+from scheduler import CHAT_SEND_RATE_KEY, SEND_RATE_KEY, Pacer, SendScheduler
+from storage import SqliteStore
+from supervisor import Supervisor, get_shard
+from tracing import TRACE_FILE_KEY, TRACE_SAMPLE_RATE_KEY, TRACE_SLOW_THRESHOLD_KEY
+from url_utils import LinkDescriptor, find_links
 from unreddit.main import unreddit
+from upstreams import REQUESTS, SHARE_MAP, echo_worker, faults, make_imgur_app, make_reddit_app
+from webhook import WEBHOOK_SECRET_KEY, WEBHOOK_URL_KEY, make_app
 
 MESSAGES = []
-SHARE_MAP = {}
 
 
 def setenv(key: str, value: str) -> None:
@@ -33,9 +61,23 @@ def bot():
 
 
 @pytest.fixture(autouse=True)
-def set_up():
+def set_up(monkeypatch):
     global MESSAGES
+
+    # Every test replies in the same chat, which is not to be paced by the replies of the tests before
+    monkeypatch.setenv(SEND_RATE_KEY, "0")
+    monkeypatch.setenv(CHAT_SEND_RATE_KEY, "0")
+    monkeypatch.setattr("scheduler._pacer", None)
+    monkeypatch.setattr("reply.SCHEDULER", SendScheduler())
+    monkeypatch.setattr("unreddit.main.SCHEDULER", SendScheduler())
+
     MESSAGES = []
+    REQUESTS.clear()
+    REDDIT_CACHE.memory.clear()
+    SHARE_CACHE.memory.clear()
+    MEDIA_CACHE.memory.clear()
+    NEGATIVE_CACHE.clear()
+    FILE_ID_CACHE.clear()
 
 
 def get_message(bot=None, text=None):
@@ -45,6 +87,10 @@ def get_message(bot=None, text=None):
     message.reply_video = AsyncMock(side_effect=lambda *args, **kwargs: get_message())
     message.reply_animation = AsyncMock(side_effect=lambda *args, **kwargs: get_message())
     message.reply_media_group = AsyncMock(side_effect=lambda media, **kwargs: [get_message() for _ in media])
+    message.photo = []
+    message.video = None
+    message.animation = None
+    message.document = None
 
     if bot:
         message.bot = bot
@@ -141,41 +187,14 @@ class InputMediaMock(object):
         return f'<InputMedia mock for {self.media}>'
 
 
-def load_response(path) -> Dict:
-    with open(path, "r") as file:
-        return json.load(file)
-
-
-def resolve_share(share_hash) -> str:
-    return SHARE_MAP[share_hash]
-
-
 @pytest.fixture
 def reddit_mock_server(aiohttp_server):
-    async def post_handler(request: Request):
-        return web.json_response(load_response(f"reddit_responses/{request.match_info['post_hash']}.json"))
-
-    async def comment_handler(request: Request):
-        return web.json_response(load_response(f"reddit_responses/{request.match_info['comment_hash']}.json"))
-
-    async def redirect_handler(request: Request):
-        return Response(status=302, headers={"Location": resolve_share(request.match_info['share_hash'])})
-
-    reddit = web.Application()
-    reddit.router.add_get("/r/{subreddit}/comments/{post_hash}/{title}/.json", post_handler)
-    reddit.router.add_get("/r/{subreddit}/comments/{post_hash}/{title}/{comment_hash}/.json", comment_handler)
-    reddit.router.add_head("/r/{subreddit}/s/{share_hash}/", redirect_handler)
-    return aiohttp_server(reddit)
+    return aiohttp_server(make_reddit_app())
 
 
 @pytest.fixture
 def imgur_mock_server(aiohttp_server):
-    async def post_handler(request: Request):
-        return web.json_response(load_response(f"imgur_responses/{request.match_info['post_hash']}.json"))
-
-    imgur = web.Application()
-    imgur.router.add_get("/3/{type}/{post_hash}", post_handler)
-    return aiohttp_server(imgur)
+    return aiohttp_server(make_imgur_app())
 
 
 @pytest.mark.asyncio
@@ -495,3 +514,1051 @@ async def test_fallback(reddit_mock_server, imgur_mock_server, bot):
         parse_mode='html',
         reply_markup=buttons
     )
+
+
+@pytest.mark.asyncio
+async def test_multiple_links(reddit_mock_server, bot):
+    image_url = "https://www.reddit.com/r/ProperAnimalNames/comments/eakgxt/caaterpillar/"
+    missing_url = "https://www.reddit.com/r/aww/comments/0000000/missing/"
+    video_url = "https://www.reddit.com/r/aww/comments/eafg2x/%CA%B8%E1%B5%83%CA%B7%E2%81%BF/"
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    async with ClientSession() as session:
+        bot.session = session
+        message = get_message(bot, f"{image_url} {missing_url}\n{video_url}")
+
+        await unreddit(message)
+
+    assert [name for name, *_ in message.mock_calls] == ["reply_photo", "reply_video"]
+
+
+@pytest.mark.asyncio
+async def test_metrics(reddit_mock_server, bot):
+    image_url = "https://www.reddit.com/r/ProperAnimalNames/comments/eakgxt/caaterpillar/"
+    missing_url = "https://www.reddit.com/r/aww/comments/0000000/missing/"
+    video_url = "https://www.reddit.com/r/aww/comments/eafg2x/%CA%B8%E1%B5%83%CA%B7%E2%81%BF/"
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    # The metrics are shared by the whole process, only their changes over the test are checked
+    ok = LOAD_RESULTS.get(loader="RedditLoader", result="ok")
+    not_found = LOAD_RESULTS.get(loader="RedditLoader", result="not_found")
+    fallbacks = SEND_FALLBACKS.get(content="Video")
+
+    async with ClientSession() as session:
+        bot.session = session
+        message = get_message(bot, f"{image_url} {missing_url}\n{video_url}")
+        message.reply_video = AsyncMock(side_effect=BadRequest("Mock Error"))
+
+        await unreddit(message)
+
+    assert LOAD_RESULTS.get(loader="RedditLoader", result="ok") - ok == 2
+    assert LOAD_RESULTS.get(loader="RedditLoader", result="not_found") - not_found == 1
+    assert SEND_FALLBACKS.get(content="Video") - fallbacks == 1
+    assert 'unreddit_send_fallbacks_total{content="Video"}' in render()
+
+
+@pytest.mark.asyncio
+async def test_cache(reddit_mock_server, bot):
+    post_url = "https://www.reddit.com/r/ProperAnimalNames/comments/eakgxt/caaterpillar/"
+    variant_url = "https://old.reddit.com/r/ProperAnimalNames/comments/EAKGXT/?utm_source=share&utm_medium=web2x"
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    async with ClientSession() as session:
+        bot.session = session
+
+        await unreddit(get_message(bot, post_url))
+
+        await reddit_server.close()
+        message = get_message(bot, variant_url)
+
+        await unreddit(message)
+
+    attachment_url = "https://preview.redd.it/x0jro2c32m441.jpg?auto=webp&s=7a26ed39ddb092ca26299ce2be0dcffd6c8800d9"
+
+    Mock.assert_called_with(
+        message.reply_photo,
+        attachment_url,
+        caption="Caaterpillar",
+        reply_markup=ANY
+    )
+
+    assert REDDIT_CACHE.memory.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_canonical_buttons(reddit_mock_server, bot):
+    post_url = "https://www.reddit.com/r/ProperAnimalNames/comments/eakgxt/caaterpillar/"
+    variant_url = "https://old.reddit.com/r/ProperAnimalNames/comments/EAKGXT/?utm_source=share&utm_medium=web2x"
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    async with ClientSession() as session:
+        bot.session = session
+
+        # The first link to the post decides what is cached, not what the buttons link to
+        first = get_message(bot, variant_url)
+        await unreddit(first)
+
+        second = get_message(bot, post_url)
+        await unreddit(second)
+
+    buttons = InlineKeyboardMarkupMock([[
+        InlineKeyboardButtonMock(url=post_url, text="Original Post"),
+        InlineKeyboardButtonMock(url="https://www.reddit.com/r/ProperAnimalNames", text="r/ProperAnimalNames")
+    ]])
+
+    assert buttons == first.reply_photo.call_args.kwargs["reply_markup"]
+    assert buttons == second.reply_photo.call_args.kwargs["reply_markup"]
+
+
+@pytest.mark.asyncio
+async def test_file_id(reddit_mock_server, bot):
+    post_url = "https://www.reddit.com/r/aww/comments/eafg2x/%CA%B8%E1%B5%83%CA%B7%E2%81%BF/"
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    def sent_video(*args, **kwargs):
+        sent = get_message()
+        sent.video = Mock(file_id="video-file-id")
+        return sent
+
+    async with ClientSession() as session:
+        bot.session = session
+
+        message = get_message(bot, post_url)
+        message.reply_video = AsyncMock(side_effect=sent_video)
+        await unreddit(message)
+
+        message = get_message(bot, post_url)
+        await unreddit(message)
+
+        Mock.assert_called_with(message.reply_video, "video-file-id", caption='ʸᵃʷⁿ', reply_markup=ANY)
+
+        message = get_message(bot, post_url)
+        message.reply_video = AsyncMock(side_effect=[BadRequest("Mock Error"), get_message()])
+        await unreddit(message)
+
+    Mock.assert_called_with(message.reply_video,
+                            "https://v.redd.it/w8qualuy4j441/DASH_720?source=fallback",
+                            caption='ʸᵃʷⁿ',
+                            reply_markup=ANY)
+
+    assert len(FILE_ID_CACHE) == 0
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests(reddit_mock_server, bot):
+    post_url = "https://www.reddit.com/r/ProperAnimalNames/comments/eakgxt/caaterpillar/"
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    async with ClientSession() as session:
+        bot.session = session
+        messages = [get_message(bot, post_url) for _ in range(3)]
+
+        await asyncio.gather(*(unreddit(message) for message in messages))
+
+    for message in messages:
+        message.reply_photo.assert_called_once()
+
+    assert len(REQUESTS) == 1
+
+
+@pytest.mark.asyncio
+async def test_share_cache(reddit_mock_server, bot):
+    share_url = "https://www.reddit.com/r/badukshitposting/s/auJDBZLHYO/"
+    post_url = "https://www.reddit.com/r/badukshitposting/comments/1hbq2co/how_the_heck_am_i_supposed_to_play_this/"
+    SHARE_MAP["auJDBZLHYO"] = post_url
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    async with ClientSession() as session:
+        bot.session = session
+
+        await unreddit(get_message(bot, share_url))
+
+        del SHARE_MAP["auJDBZLHYO"]
+        REDDIT_CACHE.memory.clear()
+        message = get_message(bot, share_url)
+
+        await unreddit(message)
+
+    message.reply_photo.assert_called_once()
+    assert SHARE_CACHE.memory.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_webhook(aiohttp_client, bot, monkeypatch):
+    monkeypatch.setenv(WEBHOOK_URL_KEY, "https://example.com")
+    monkeypatch.setenv(WEBHOOK_SECRET_KEY, "secret")
+
+    bot.request = AsyncMock()
+    bot.close = AsyncMock()
+    bot.loop = asyncio.get_running_loop()
+    dp = Dispatcher(bot)
+
+    received = asyncio.Event()
+
+    async def handler(message: Message):
+        received.set()
+
+    dp.register_message_handler(handler)
+
+    client = await aiohttp_client(make_app(dp))
+    update = {"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"},
+                                          "from": {"id": 1, "is_bot": False, "first_name": "foo"}, "text": "foo"}}
+
+    response = await client.post("/webhook", json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+    assert response.status == 403
+
+    response = await client.post("/webhook", json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "secret"})
+    assert response.status == 200
+
+    await asyncio.wait_for(received.wait(), 1)
+
+    assert bot.request.call_args.args[1]["url"] == "https://example.com/webhook"
+    assert bot.request.call_args.args[1]["secret_token"] == "secret"
+
+
+@pytest.mark.asyncio
+async def test_persistent_cache(reddit_mock_server, imgur_mock_server, bot, tmp_path):
+    post_url = "https://www.reddit.com/r/firebrigade/comments/dxhrr1/fire_forces_princess_hibana_wallpaper_series/"
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+    imgur_server = await imgur_mock_server
+    setenv(IMGUR_API_URL_KEY, f"{imgur_server.make_url('')}")
+
+    REDDIT_CACHE.store = SqliteStore(str(tmp_path / "cache.sqlite"), "content")
+
+    try:
+        async with ClientSession() as session:
+            bot.session = session
+
+            first = get_message(bot, post_url)
+            await unreddit(first)
+
+            # Restart: the memory is empty, and so are the upstreams
+            REDDIT_CACHE.memory.clear()
+            await reddit_server.close()
+            await imgur_server.close()
+
+            second = get_message(bot, post_url)
+            await unreddit(second)
+
+    finally:
+        REDDIT_CACHE.store.close()
+        REDDIT_CACHE.store = None
+
+    assert second.reply_media_group.call_args == first.reply_media_group.call_args
+    assert MESSAGES[MESSAGES.index(second) + 1].reply.call_args == MESSAGES[1].reply.call_args
+
+
+def test_busy_store(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = TieredCache(LRUCache(16), SqliteStore(path, "content"))
+    cache.put("stored", "value")
+
+    # Another worker writing to the store
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN EXCLUSIVE")
+
+    try:
+        started = time.monotonic()
+        cache.put("busy", "value")
+
+        assert time.monotonic() - started < 1
+        assert cache.get("busy") == "value"
+
+        cache.memory.clear()
+        assert cache.get("stored") == "value"
+
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+
+    assert cache.get_stored("busy") is None
+
+    cache.put("busy", "value")
+    assert cache.get_stored("busy") == "value"
+
+    cache.store.close()
+
+
+def test_find_links():
+    text = ("https://old.reddit.com/r/aww/comments/EAFG2X/title/?utm_source=share "
+            "and https://www.reddit.com/r/ShitpostXIV/comments/1hl0gyj/breaking_news/m3ij6ht/ "
+            "https://www.reddit.com/r/badukshitposting/s/auJDBZLHYO "
+            "https://www.reddit.com/r/aww/ https://example.com/comments/foo "
+            "https://i.imgur.com/r8v9NAI.mp4 https://imgur.com/gallery/sAcGyrf")
+
+    assert find_links(text) == [
+        LinkDescriptor("https://old.reddit.com/r/aww/comments/EAFG2X/title/?utm_source=share",
+                       "reddit", "post", post_id="eafg2x"),
+        LinkDescriptor("https://www.reddit.com/r/ShitpostXIV/comments/1hl0gyj/breaking_news/m3ij6ht/",
+                       "reddit", "comment", post_id="1hl0gyj", comment_id="m3ij6ht"),
+        LinkDescriptor("https://www.reddit.com/r/badukshitposting/s/auJDBZLHYO",
+                       "reddit", "share", share_token="auJDBZLHYO"),
+        LinkDescriptor("https://i.imgur.com/r8v9NAI.mp4", "imgur", "image", post_id="r8v9NAI"),
+        LinkDescriptor("https://imgur.com/gallery/sAcGyrf", "imgur", "album", post_id="sAcGyrf"),
+    ]
+
+
+def test_content_immutability():
+    image = Image("https://example.com/image.jpg", None, "Image", renditions=["https://example.com/small.jpg"])
+
+    with pytest.raises(AttributeError):
+        image.caption = "Changed"
+
+    with pytest.raises(AttributeError):
+        del image.payload
+
+    assert image.renditions == ("https://example.com/small.jpg",)
+    assert image.thumbnail == "https://example.com/image.jpg"
+    assert hash(image) == hash(Image("https://example.com/image.jpg", None, "Image",
+                                     renditions=["https://example.com/small.jpg"]))
+
+
+def test_content_replace():
+    image = Image("https://example.com/image.jpg", None, "Image", renditions=["https://example.com/small.jpg"])
+    replaced = image.replace(caption="Replaced")
+
+    assert isinstance(replaced, Image)
+    assert replaced.caption == "Replaced"
+    assert replaced.replace(caption="Image") == image
+    assert image.caption == "Image"
+    assert replaced.renditions == image.renditions
+
+    with pytest.raises(TypeError):
+        image.replace(captoin="Misspelled")
+
+
+def test_content_serialization():
+    album = Album([Image("https://example.com/image.jpg", None, "Image", renditions=["https://example.com/small.jpg"]),
+                   Animation("https://example.com/animation.gif", None, None, renditions=["https://example.com/a.mp4"]),
+                   Video("https://example.com/video.mp4", "https://example.com/thumbnail.jpg", "Video")],
+                  "https://example.com/album", "Album")
+    metadata = StoredMetadata([Button("Original Post", "https://example.com/post")])
+
+    for content in (album, Link("https://example.com/", "a < b & c"), Text("*Comment*", parse_mode="markdown")):
+        loaded, loaded_metadata = loads(dumps((content, metadata)))
+
+        assert type(loaded) is type(content)
+        assert loaded == content
+        assert loaded_metadata.get_buttons() == metadata.get_buttons()
+
+    loaded, _ = loads(dumps((album, metadata)))
+
+    assert loaded.payload[0].renditions == ("https://example.com/small.jpg",)
+    assert isinstance(loaded.payload, tuple)
+
+
+def test_html_escaping():
+    link = Link("https://example.com/?a=1&b=\"2\"", "a < b & c")
+    video = Video("https://example.com/video.mp4?a=1&b=2", None, "a < b & c")
+
+    assert link.payload == '<a href="https://example.com/?a=1&amp;b=&quot;2&quot;">🔗</a> a &lt; b &amp; c'
+    assert link.caption == "a < b & c"
+    assert video.get_embed_fallback_message() == ('<a href="https://example.com/video.mp4?a=1&amp;b=2">🎬 a &lt; b &amp; c</a>'
+                                                  '\n\n'
+                                                  '[Telegram wasn\'t able to embed the video]')
+
+
+@pytest.mark.asyncio
+async def test_direct_imgur(imgur_mock_server, bot):
+    imgur_server = await imgur_mock_server
+    setenv(IMGUR_API_URL_KEY, f"{imgur_server.make_url('')}")
+
+    async with ClientSession() as session:
+        bot.session = session
+        message = get_message(bot, "https://i.imgur.com/r8v9NAI.mp4")
+
+        await unreddit(message)
+
+    Mock.assert_called_with(
+        message.reply_video,
+        "https://i.imgur.com/r8v9NAI.mp4",
+        caption="Giving a fennec fox a bath",
+        reply_markup=InlineKeyboardMarkupMock([])
+    )
+
+
+@pytest.mark.asyncio
+async def test_tracing(reddit_mock_server, imgur_mock_server, bot, tmp_path, caplog, monkeypatch):
+    post_url = "https://www.reddit.com/r/aww/comments/aie643/giving_a_fennec_fox_a_bath/"
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+    imgur_server = await imgur_mock_server
+    setenv(IMGUR_API_URL_KEY, f"{imgur_server.make_url('')}")
+
+    monkeypatch.setenv(TRACE_FILE_KEY, str(tmp_path / "traces.jsonl"))
+    monkeypatch.setenv(TRACE_SAMPLE_RATE_KEY, "1")
+    monkeypatch.setenv(TRACE_SLOW_THRESHOLD_KEY, "0")
+
+    async with ClientSession() as session:
+        bot.session = session
+        await unreddit(get_message(bot, post_url))
+
+    with open(tmp_path / "traces.jsonl") as file:
+        events = json.loads(file.readline())["traceEvents"]
+
+    assert [event["name"] for event in events] == ["update", "load", "fetch", "parse", "load", "fetch", "parse", "send"]
+    assert [event["args"].get("loader") for event in events if event["name"] == "load"] == ["RedditLoader",
+                                                                                            "ImgurLoader"]
+    assert "Slow update" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_rate_limit(aiohttp_server, bot):
+    post_url = "https://www.reddit.com/r/ProperAnimalNames/comments/eakgxt/caaterpillar/"
+    throttled = []
+
+    @web.middleware
+    async def throttle(request, handler):
+        if not throttled:
+            throttled.append(request.path)
+            return web.Response(status=429, headers={"Retry-After": "0.1"})
+
+        return await handler(request)
+
+    reddit_server = await aiohttp_server(make_reddit_app([throttle]))
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    async with ClientSession() as session:
+        bot.session = session
+        message = get_message(bot, post_url)
+
+        started = asyncio.get_event_loop().time()
+        await unreddit(message)
+
+    assert asyncio.get_event_loop().time() - started >= 0.1
+    assert len(REQUESTS) == 1
+    assert UPSTREAM_RESPONSES.get(upstream="reddit", status=429) >= 1
+
+    Mock.assert_called_once(message.reply_photo)
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_queue():
+    limiter = RateLimiter("test", burst=10)
+    limiter.update(200, {"X-Ratelimit-Remaining": "2", "X-Ratelimit-Reset": "100"})
+
+    await limiter.acquire()
+    await limiter.acquire()
+
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(limiter.acquire(), 0.05)
+
+    limiter = RateLimiter("test", burst=10)
+    limiter.update(429, {"Retry-After": "0.05"})
+    served = []
+
+    async def request(name, priority):
+        with prioritized(priority):
+            await limiter.acquire()
+            served.append(name)
+
+    requests = [asyncio.ensure_future(request("old message", MESSAGE_PRIORITY)),
+                asyncio.ensure_future(request("new message", MESSAGE_PRIORITY)),
+                asyncio.ensure_future(request("inline", INLINE_PRIORITY))]
+    await asyncio.sleep(0)
+
+    assert len(limiter) == 3
+
+    await asyncio.gather(*requests)
+
+    assert served == ["inline", "new message", "old message"]
+
+
+@pytest.mark.asyncio
+async def test_negative_cache(reddit_mock_server, bot):
+    missing_url = "https://www.reddit.com/r/aww/comments/0000000/missing/"
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    async with ClientSession() as session:
+        bot.session = session
+
+        for _ in range(3):
+            message = get_message(bot, missing_url)
+            await unreddit(message)
+
+            assert not message.mock_calls
+
+    assert len(REQUESTS) == 1
+    assert NEGATIVE_CACHE.get("reddit:post:0000000:") == "not_found"
+    assert LOAD_RESULTS.get(loader="RedditLoader", result="cached_not_found") >= 2
+
+
+@pytest.mark.asyncio
+async def test_media_failure(reddit_mock_server, aiohttp_server, bot, monkeypatch):
+    post_url = "https://www.reddit.com/r/aww/comments/aie643/giving_a_fennec_fox_a_bath/"
+    imgur_down = True
+
+    @web.middleware
+    async def outage(request, handler):
+        return web.Response(status=503) if imgur_down else await handler(request)
+
+    monkeypatch.setitem(NEGATIVE_CACHE_TTLS, "upstream_error", 0.05)
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+    imgur_server = await aiohttp_server(make_imgur_app([outage]))
+    setenv(IMGUR_API_URL_KEY, f"{imgur_server.make_url('')}")
+
+    async with ClientSession() as session:
+        bot.session = session
+
+        for _ in range(2):
+            message = get_message(bot, post_url)
+            await unreddit(message)
+
+            assert [name for name, *_ in message.mock_calls] == ["reply"]
+            assert "https://i.imgur.com/r8v9NAI.gifv" in message.reply.call_args.args[0]
+
+        assert NEGATIVE_CACHE.get("imgur:image:r8v9NAI:") == "upstream_error"
+        assert NEGATIVE_CACHE.get("reddit:post:aie643:") is None
+
+        # The link the post has made do with is kept no longer than the failure of the media
+        imgur_down = False
+        await asyncio.sleep(0.1)
+
+        for _ in range(100):
+            message = get_message(bot, post_url)
+            await unreddit(message)
+
+            if message.reply_video.called:
+                break
+
+            await asyncio.sleep(0.01)
+
+    Mock.assert_called_once(message.reply_video)
+
+
+@pytest.mark.asyncio
+async def test_stale_while_revalidate(aiohttp_server, bot, monkeypatch):
+    post_url = "https://www.reddit.com/r/ProperAnimalNames/comments/eakgxt/caaterpillar/"
+    not_modified = []
+
+    @web.middleware
+    async def etag(request, handler):
+        if request.headers.get("If-None-Match") == '"eakgxt"':
+            not_modified.append(request.path)
+            return web.Response(status=304)
+
+        response = await handler(request)
+        response.headers["ETag"] = '"eakgxt"'
+        return response
+
+    cache = TieredCache(LRUCache(16, ttl=0.05, grace=60))
+    monkeypatch.setattr(RedditLoader, "cache", cache)
+
+    reddit_server = await aiohttp_server(make_reddit_app([etag]))
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    async with ClientSession() as session:
+        bot.session = session
+
+        await unreddit(get_message(bot, post_url))
+        await asyncio.sleep(0.1)
+
+        message = get_message(bot, post_url)
+        await unreddit(message)
+
+        # Served stale right away, without waiting for the upstream
+        Mock.assert_called_once(message.reply_photo)
+        assert len(not_modified) == 0
+
+        for _ in range(100):
+            if not_modified:
+                break
+
+            await asyncio.sleep(0.01)
+
+    assert len(REQUESTS) == 1
+    assert not_modified == ["/by_id/t3_eakgxt.json"]
+    assert cache.memory.get("reddit:post:eakgxt:") is not None
+    assert cache.memory.stale_hits == 1
+
+
+@pytest.mark.asyncio
+async def test_conditional_single_flight(aiohttp_server):
+    @web.middleware
+    async def etag(request, handler):
+        await asyncio.sleep(0.05)
+
+        if request.headers.get("If-None-Match") == '"eakgxt"':
+            return web.Response(status=304)
+
+        response = await handler(request)
+        response.headers["ETag"] = '"eakgxt"'
+        return response
+
+    reddit_server = await aiohttp_server(make_reddit_app([etag]))
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    async with ClientSession() as session:
+        loader = RedditLoader(session)
+        url = loader.get_posts_url(["eakgxt"])
+
+        await loader._load(url)
+
+        async def revalidate():
+            _revalidating.set(loader)
+            return await loader._load(url)
+
+        # The plain request made while the conditional one is in flight does not share its 304
+        revalidated, loaded = await asyncio.gather(revalidate(), RedditLoader(session)._load(url),
+                                                   return_exceptions=True)
+
+    assert isinstance(revalidated, NotModifiedError)
+    assert loaded["data"]["children"][0]["data"]["id"] == "eakgxt"
+    assert len(REQUESTS) == 2
+
+
+@pytest.mark.asyncio
+async def test_stored_revalidate(reddit_mock_server, bot, monkeypatch, tmp_path):
+    post_url = "https://www.reddit.com/r/ProperAnimalNames/comments/eakgxt/caaterpillar/"
+
+    monkeypatch.setenv(CONTENT_CACHE_PATH_KEY, str(tmp_path / "cache.sqlite3"))
+    store = SqliteStore(os.environ[CONTENT_CACHE_PATH_KEY], "content", ttl=3600)
+    cache = TieredCache(LRUCache(16, ttl=300, grace=600), store, dump=dumps, load=loads)
+    monkeypatch.setattr(RedditLoader, "cache", cache)
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    try:
+        async with ClientSession() as session:
+            bot.session = session
+
+            await unreddit(get_message(bot, post_url))
+
+            # Restart: the post is only in the store, which keeps it longer than the memory would
+            cache.memory.clear()
+
+            message = get_message(bot, post_url)
+            await unreddit(message)
+
+            Mock.assert_called_once(message.reply_photo)
+
+            for _ in range(100):
+                if len(REQUESTS) > 1:
+                    break
+
+                await asyncio.sleep(0.01)
+
+    finally:
+        store.close()
+
+    assert REQUESTS == ["/by_id/t3_eakgxt.json", "/by_id/t3_eakgxt.json"]
+    assert cache.memory.get("reddit:post:eakgxt:") is not None
+
+
+@pytest.mark.asyncio
+async def test_renditions(reddit_mock_server):
+    video_url = "https://www.reddit.com/r/aww/comments/eafg2x/%CA%B8%E1%B5%83%CA%B7%E2%81%BF/"
+    gif_url = "https://www.reddit.com/r/vexillologycirclejerk/comments/1hatfow/flag_of_sweden_but_jesus_died_of_a_bad_apple/"
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    async with ClientSession() as session:
+        video, _ = await RedditLoader(session).load(video_url)
+        animation, _ = await RedditLoader(session).load(gif_url)
+
+    assert video.renditions == ("https://v.redd.it/w8qualuy4j441/DASH_480?source=fallback",
+                                "https://v.redd.it/w8qualuy4j441/DASH_360?source=fallback",
+                                "https://v.redd.it/w8qualuy4j441/DASH_240?source=fallback")
+    assert "format=mp4" in animation.renditions[0]
+
+
+@pytest.mark.asyncio
+async def test_preflight(aiohttp_server):
+    files = {
+        "/big.jpg": (10 * 1024 * 1024, "image/jpeg"),
+        "/small.jpg": (100 * 1024, "image/jpeg"),
+        "/page": (1024, "text/html; charset=utf-8"),
+        "/preview": (100 * 1024, "image/webp"),
+        "/unknown": (100 * 1024, "application/octet-stream"),
+    }
+
+    async def head_handler(request):
+        size, content_type = files[request.path]
+        return web.Response(headers={"Content-Length": str(size), "Content-Type": content_type})
+
+    media_app = web.Application()
+    media_app.router.add_head("/{name}", head_handler)
+    media_server = await aiohttp_server(media_app)
+
+    big, small, page, preview, unknown = (str(media_server.make_url(path)) for path in files)
+
+    async with ClientSession() as session:
+        image = await preflight(Image(big, None, "Image", renditions=[page, small]), session)
+        album = await preflight(Album([Image(big, None, "Too big"), Image(small, None, "Fits")], big, "Album"),
+                                session)
+        video = await preflight(Video(page, None, "Video"), session)
+        webp = await preflight(Image(preview, None, "WebP"), session)
+        untyped = await preflight(Video(unknown, None, "Untyped"), session)
+
+        dropped = PREFLIGHT_RESULTS.get(content="Image", result="dropped")
+        larger_album = await preflight(Album([Image(small, None, "Fits"), Image(page, None, "Not an image"),
+                                              Image(small, None, "Fits too")], big, "Album"), session)
+
+    assert image.payload == small
+    assert image.fallback == big
+    assert isinstance(album, Image)
+    assert album.payload == small
+    assert album.caption == "Album"
+    assert [media.caption for media in larger_album.payload] == ["Fits", "Fits too"]
+    assert PREFLIGHT_RESULTS.get(content="Image", result="dropped") - dropped == 1
+    assert isinstance(video, Text)
+    assert "wasn't able to embed the video" in video.payload
+    assert webp.payload == preview
+    assert untyped.payload == unknown
+
+
+@pytest.mark.asyncio
+async def test_preflight_error(monkeypatch):
+    monkeypatch.setenv(PREFLIGHT_ERROR_CACHE_TTL_KEY, "0.05")
+    unreachable = "http://127.0.0.1:1/image.jpg"
+
+    async with ClientSession() as session:
+        image = await preflight(Image(unreachable, None, "Image"), session)
+
+    assert isinstance(image, Text)
+    assert PREFLIGHT_CACHE.get(unreachable) == (0, None, None)
+
+    # Checked again before long, unlike the media that has been checked
+    await asyncio.sleep(0.1)
+    assert PREFLIGHT_CACHE.get(unreachable) is None
+
+
+@pytest.mark.asyncio
+async def test_relay(aiohttp_server, monkeypatch):
+    files = {
+        "/video": 300 * 1024,
+        "/huge.mp4": 2 * 1024 * 1024,
+    }
+
+    async def get_handler(request):
+        return web.Response(body=b"\0" * files[request.path], content_type="video/mp4")
+
+    media_app = web.Application()
+    media_app.router.add_get("/{name}", get_handler)
+    media_server = await aiohttp_server(media_app)
+
+    monkeypatch.setenv(RELAY_KEY, "1")
+    monkeypatch.setenv(RELAY_SIZE_LIMIT_KEY, str(1024 * 1024))
+    monkeypatch.setenv(RELAY_SPOOL_SIZE_KEY, str(64 * 1024))
+
+    video, huge = (str(media_server.make_url(path)) for path in files)
+    uploads = []
+
+    def upload(file, **kwargs):
+        if isinstance(file, str):
+            raise BadRequest("Mock Error")
+
+        uploads.append((file.filename, len(file.file.read())))
+
+        # The first upload hits the flood control, after reading the file through
+        if len(uploads) == 1:
+            raise RetryAfter(0)
+
+        sent = get_message()
+        sent.video = Mock(file_id="relayed-file-id")
+        return sent
+
+    async with ClientSession() as session:
+        message = get_message(Mock(session=session))
+        message.reply_video = AsyncMock(side_effect=upload)
+        await Reply(message, Video(video, None, "Relayed"), StoredMetadata([])).send()
+
+        message = get_message(Mock(session=session))
+        message.reply_video = AsyncMock(side_effect=BadRequest("Mock Error"))
+        await Reply(message, Video(huge, None, "Too big"), StoredMetadata([])).send()
+
+    assert uploads == [("video.mp4", 300 * 1024), ("video.mp4", 300 * 1024)]
+    assert FILE_ID_CACHE.get(video) == "relayed-file-id"
+    assert message.reply_video.call_count == 1
+    assert "wasn't able to embed the video" in message.reply.call_args.args[0]
+
+
+@pytest.mark.asyncio
+async def test_send_scheduler(monkeypatch):
+    monkeypatch.setenv(CHAT_SEND_RATE_KEY, "100")
+
+    scheduler = SendScheduler()
+    events = []
+
+    async def unit(name: str, *sends):
+        for send in sends:
+            await scheduler.call(send, name)
+
+    def flooded(times: int):
+        async def send(name):
+            nonlocal times
+
+            if times:
+                times -= 1
+                raise RetryAfter(0.1)
+
+            events.append(name)
+
+        return send
+
+    async def sent(name):
+        await asyncio.sleep(0.01)
+        events.append(name)
+
+    flooded_chat, other_chat = Mock(id=1, type="private"), Mock(id=2, type="private")
+
+    await asyncio.gather(
+        scheduler.submit(flooded_chat, lambda: unit("album", flooded(1), sent), cost=2),
+        scheduler.submit(flooded_chat, lambda: unit("text", sent)),
+        scheduler.submit(other_chat, lambda: unit("other", sent)),
+    )
+
+    # The flood control holds up its own chat only, and the units of a chat are neither split nor reordered
+    assert events == ["other", "album", "album", "text"]
+
+    with pytest.raises(RetryAfter):
+        await scheduler.submit(other_chat, lambda: unit("other", flooded(10)))
+
+    # The chats are forgotten once they have caught up with their pace
+    await asyncio.sleep(0.05)
+    assert len(scheduler) == 0
+
+
+@pytest.mark.asyncio
+async def test_album_cost(reddit_mock_server, bot, monkeypatch):
+    post_url = "https://www.reddit.com/r/masseffect/comments/ioubvj/for_13_year_old_game_it_sure_is_stunning_visuals/"
+
+    scheduler = SendScheduler()
+    monkeypatch.setattr(scheduler, "submit", AsyncMock(wraps=scheduler.submit))
+    monkeypatch.setattr("reply.SCHEDULER", scheduler)
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    async with ClientSession() as session:
+        bot.session = session
+        await unreddit(get_message(bot, post_url))
+
+    # Three images, and the caption sent along with them
+    assert scheduler.submit.call_args.kwargs["cost"] == 4
+
+
+@pytest.mark.asyncio
+async def test_fallback_cost(reddit_mock_server, bot, monkeypatch):
+    post_url = "https://www.reddit.com/r/Animemes/comments/e7eno4/mob_chuuni_200_op_chuunibyou_x_mob_psycho_100/"
+
+    scheduler = SendScheduler()
+    monkeypatch.setattr(scheduler, "charge", AsyncMock(wraps=scheduler.charge))
+    monkeypatch.setattr("reply.SCHEDULER", scheduler)
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    async with ClientSession() as session:
+        bot.session = session
+        message = get_message(bot, post_url)
+        message.reply_video = AsyncMock(side_effect=BadRequest("Mock Error"))
+
+        await unreddit(message)
+
+    # The link sent in place of the video is paced as a send of its own
+    Mock.assert_called_once(message.reply)
+    Mock.assert_called_once_with(scheduler.charge, message.chat)
+
+
+@pytest.mark.asyncio
+async def test_pacer():
+    pacer = Pacer(rate=20, burst=2)
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+
+    for _ in range(4):
+        await pacer.wait()
+
+    # Two sends go at once, the other two a twentieth of a second apart
+    assert 0.09 <= loop.time() - started < 0.2
+
+
+def test_shard():
+    def message(chat_id: int, user_id: int):
+        return {"update_id": 1, "message": {"chat": {"id": chat_id}, "from": {"id": user_id}}}
+
+    assert get_shard(message(5, 1), 4) == get_shard(message(5, 2), 4) == 1
+    assert get_shard(message(-1001, 1), 4) == 3
+    assert get_shard({"update_id": 1, "inline_query": {"from": {"id": 6}}}, 4) == 2
+    assert get_shard({"update_id": 7}, 4) == 3
+
+
+@pytest.mark.asyncio
+async def test_supervisor(monkeypatch, tmp_path):
+    monkeypatch.setattr("supervisor.WORKER_CHECK_INTERVAL", 0.1)
+    monkeypatch.setenv(CONTENT_CACHE_PATH_KEY, str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setenv(SHARE_CACHE_PATH_KEY, str(tmp_path / "cache.sqlite3"))
+
+    loop = asyncio.get_event_loop()
+    results = get_context("spawn").Queue()
+    supervisor = Supervisor(partial(echo_worker, results), 2)
+    supervisor.start()
+
+    try:
+        for update_id, chat_id in enumerate((1, 2, 3)):
+            supervisor.route({"update_id": update_id, "message": {"chat": {"id": chat_id}}})
+
+        # The worker of the odd chats crashes, and the updates routed to it meanwhile are handled once it is back
+        supervisor.route({"update_id": 3, "crash": True, "message": {"chat": {"id": 1}}})
+        supervisor.route({"update_id": 4, "message": {"chat": {"id": 5}}})
+
+        handled = {await loop.run_in_executor(None, results.get, True, 30) for _ in range(4)}
+
+    finally:
+        await supervisor.stop()
+
+    assert handled == {(1, 0), (0, 1), (1, 2), (1, 4)}
+    assert WORKER_RESTARTS.get() >= 1
+
+
+@pytest.mark.asyncio
+async def test_supervisor_killed_worker(monkeypatch, tmp_path):
+    monkeypatch.setattr("supervisor.WORKER_CHECK_INTERVAL", 0.1)
+    monkeypatch.setenv(CONTENT_CACHE_PATH_KEY, str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setenv(SHARE_CACHE_PATH_KEY, str(tmp_path / "cache.sqlite3"))
+
+    loop = asyncio.get_event_loop()
+    results = get_context("spawn").Queue()
+    supervisor = Supervisor(partial(echo_worker, results), 1)
+    supervisor.start()
+
+    try:
+        supervisor.route({"update_id": 0, "ping": True, "message": {"chat": {"id": 1}}})
+        _, pid = await loop.run_in_executor(None, results.get, True, 30)
+
+        # Killed while waiting for an update, holding the lock of its queue
+        await asyncio.sleep(0.1)
+        os.kill(pid, signal.SIGKILL)
+
+        supervisor.route({"update_id": 1, "message": {"chat": {"id": 1}}})
+        supervisor.route({"update_id": 2, "message": {"chat": {"id": 1}}})
+
+        handled = [await loop.run_in_executor(None, results.get, True, 30) for _ in range(2)]
+
+    finally:
+        await supervisor.stop()
+
+    assert handled == [(0, 1), (0, 2)]
+
+
+def test_lazy_loader():
+    # In a process of its own, as the loader may have been imported by the tests before
+    check = ("import sys\n"
+             "import loaders, main\n"
+             "from url_utils import find_links\n"
+             "assert 'loaders.gfycat' not in sys.modules\n"
+             "link, = find_links('https://gfycat.com/happyfox-cute')\n"
+             "assert 'loaders.gfycat' in sys.modules\n")
+    unreddit_path = Path(__file__).parent.parent / "unreddit"
+
+    subprocess.run([sys.executable, "-c", check], check=True, cwd=unreddit_path,
+                   env={**os.environ, "PYTHONPATH": str(unreddit_path)})
+
+    link, = find_links("https://gfycat.com/happyfox-cute")
+
+    assert link.site == "gfycat"
+    assert link.post_id == "happyfox"
+    assert get_loader("gfycat").upstream == "gfycat"
+
+
+def test_startup_metrics():
+    observe_startup("first_update")
+    first_update = STARTUP_SECONDS.get(phase="first_update")
+    observe_startup("first_update")
+
+    # Only the first time counts
+    assert 0 < first_update == STARTUP_SECONDS.get(phase="first_update")
+    assert 'unreddit_startup_seconds{phase="first_update"}' in render()
+
+
+@pytest.mark.asyncio
+async def test_batched_posts_failure(aiohttp_server):
+    urls = ["https://www.reddit.com/r/ProperAnimalNames/comments/eakgxt/caaterpillar/",
+            "https://www.reddit.com/r/aww/comments/eafg2x/%CA%B8%E1%B5%83%CA%B7%E2%81%BF/",
+            "https://www.reddit.com/r/aww/comments/0000000/missing/"]
+    failed = []
+
+    @web.middleware
+    async def unavailable(request, handler):
+        failed.append(request.path)
+        return web.Response(status=503)
+
+    reddit_server = await aiohttp_server(make_reddit_app([unavailable]))
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    async with ClientSession() as session:
+        results = await asyncio.gather(*(RedditLoader(session).load(url) for url in urls), return_exceptions=True)
+
+    # The failure of the batch is the failure of every post in it, which are not requested one by one on top of it
+    assert all(isinstance(result, ClientResponseError) and result.status == 503 for result in results)
+    assert failed == ["/by_id/t3_eakgxt,t3_eafg2x,t3_0000000.json"]
+
+
+@pytest.mark.asyncio
+async def test_batcher_context():
+    batcher = Batcher("test", window=0.01, size=10)
+    caller: ContextVar[Optional[str]] = ContextVar("caller", default=None)
+    loaded = []
+
+    async def load_many(keys):
+        loaded.append((keys, get_priority(), caller.get()))
+        return {key: key.upper() for key in keys}
+
+    async def load(key: str, priority: int):
+        caller.set(key)
+
+        with prioritized(priority):
+            return await batcher.load(key, load_many, lambda: None)
+
+    # The refresh opens the batch, but the batch is loaded for the message as much as for it
+    results = await asyncio.gather(load("refresh", REVALIDATION_PRIORITY), load("message", MESSAGE_PRIORITY))
+
+    assert results == ["REFRESH", "MESSAGE"]
+    assert loaded == [(["refresh", "message"], MESSAGE_PRIORITY, None)]
+
+
+@pytest.mark.asyncio
+async def test_batched_posts(reddit_mock_server):
+    image_url = "https://www.reddit.com/r/ProperAnimalNames/comments/eakgxt/caaterpillar/"
+    video_url = "https://www.reddit.com/r/aww/comments/eafg2x/%CA%B8%E1%B5%83%CA%B7%E2%81%BF/"
+    missing_url = "https://www.reddit.com/r/aww/comments/0000000/missing/"
+
+    reddit_server = await reddit_mock_server
+    setenv(REDDIT_API_URL_KEY, f"{reddit_server.make_url('')}")
+
+    async with ClientSession() as session:
+        (image, _), (video, _), missing = await asyncio.gather(
+            *(RedditLoader(session).load(url) for url in (image_url, video_url, missing_url)),
+            return_exceptions=True
+        )
+
+    assert isinstance(image, Image)
+    assert isinstance(video, Video)
+    assert isinstance(missing, ClientResponseError)
+
+    # The post Reddit has not found in the batch is loaded alone, to tell why
+    assert REQUESTS == ["/by_id/t3_eakgxt,t3_eafg2x,t3_0000000.json", "/by_id/t3_0000000.json"]
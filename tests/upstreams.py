@@ -0,0 +1,186 @@
+import asyncio
+import json
+import os
+import random
+import time
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+from aiogram import Bot
+from aiohttp import web
+from aiohttp.web_request import Request
+from aiohttp.web_response import Response
+
+RESPONSES_PATH = Path(__file__).parent
+
+# Paths of the posts requested from the Reddit stand-in
+REQUESTS: List[str] = []
+
+# Share link tokens, mapped to the permalinks they redirect to
+SHARE_MAP: Dict[str, str] = {}
+
+
+@lru_cache(maxsize=None)
+def load_response(path: str, raw_json: bool = False) -> Dict:
+    with open(RESPONSES_PATH / path, "r") as file:
+        text = file.read()
+
+    # The recorded responses are HTML-escaped, the same as Reddit does unless asked for raw_json
+    if raw_json:
+        text = text.replace("&lt;", "<").replace("&gt;", ">").replace("&amp;", "&")
+
+    return json.loads(text)
+
+
+@lru_cache(maxsize=None)
+def find_response(directory: str, name: str) -> str:
+    """
+    Unknown posts get the response of the post their id starts with, so that there can be as many distinct posts
+    as needed
+    """
+    for file_name in sorted(os.listdir(RESPONSES_PATH / directory)):
+        if name.startswith(file_name[:-len(".json")]):
+            return f"{directory}/{file_name}"
+
+    raise web.HTTPNotFound()
+
+
+def resolve_share(share_hash: str) -> str:
+    return SHARE_MAP[share_hash]
+
+
+def faults(latency: Optional[Callable[[], float]] = None, error_rate: float = 0.0,
+           error_statuses: Sequence[int] = (503,)):
+    """
+    Middleware delaying the responses by `latency()` seconds and failing `error_rate` of them
+    with one of `error_statuses`
+    """
+
+    @web.middleware
+    async def middleware(request: Request, handler):
+        if latency is not None:
+            await asyncio.sleep(latency())
+
+        if error_rate and random.random() < error_rate:
+            return Response(status=random.choice(error_statuses))
+
+        return await handler(request)
+
+    return middleware
+
+
+def make_reddit_app(middlewares: Sequence = ()) -> web.Application:
+    async def post_handler(request: Request):
+        REQUESTS.append(request.path)
+        post_ids = [name[len("t3_"):] for name in request.match_info['names'].split(",")]
+
+        if len(post_ids) == 1:
+            op, _ = load_response(find_response("reddit_responses", post_ids[0]),
+                                  raw_json=request.query.get("raw_json") == "1")
+            return web.json_response(op)
+
+        # The posts found, under the ids they have been asked for, the same as Reddit leaves out the missing ones
+        children = []
+
+        for post_id in post_ids:
+            try:
+                op, _ = load_response(find_response("reddit_responses", post_id),
+                                      raw_json=request.query.get("raw_json") == "1")
+
+            except web.HTTPNotFound:
+                continue
+
+            child, = op["data"]["children"]
+            children.append({**child, "data": {**child["data"], "id": post_id, "name": f"t3_{post_id}"}})
+
+        return web.json_response({"kind": "Listing", "data": {"children": children}})
+
+    async def comment_handler(request: Request):
+        return web.json_response(load_response(f"reddit_responses/{request.match_info['comment_hash']}.json",
+                                               raw_json=request.query.get("raw_json") == "1"))
+
+    async def redirect_handler(request: Request):
+        return Response(status=302, headers={"Location": resolve_share(request.match_info['share_hash'])})
+
+    async def subreddit_handler(request: Request):
+        subreddit = request.match_info['subreddit']
+        return web.json_response({"data": {"children": [{"data": {"subreddit_name_prefixed": f"r/{subreddit}"}}]}})
+
+    reddit = web.Application(middlewares=middlewares)
+    reddit.router.add_get("/by_id/{names}.json", post_handler)
+    reddit.router.add_get("/r/{subreddit}/comments/{post_hash}/{title}/{comment_hash}/.json", comment_handler)
+    reddit.router.add_head("/r/{subreddit}/s/{share_hash}/", redirect_handler)
+    reddit.router.add_get("/r/{subreddit}.json", subreddit_handler)
+    return reddit
+
+
+def make_imgur_app(middlewares: Sequence = ()) -> web.Application:
+    async def post_handler(request: Request):
+        return web.json_response(load_response(f"imgur_responses/{request.match_info['post_hash']}.json"))
+
+    imgur = web.Application(middlewares=middlewares)
+    imgur.router.add_get("/3/{type}/{post_hash}", post_handler)
+    return imgur
+
+
+class SinkBot(Bot):
+    """
+    Bot that answers the Telegram API calls itself instead of sending them, counting them by method
+    """
+
+    def __init__(self, latency: float = 0.0, **kwargs):
+        super().__init__("123456:sink", **kwargs)
+
+        self.latency = latency
+        self.calls = Counter()
+        self.__message_id = 0
+
+    async def request(self, method: str, data: Optional[Dict] = None, files: Optional[Dict] = None,
+                      **kwargs) -> Union[List, Dict, bool]:
+        self.calls[method] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "sendMediaGroup":
+            return [self.__message(data) for _ in json.loads(data["media"])]
+
+        if method.startswith("send"):
+            return self.__message(data)
+
+        return True
+
+    def __message(self, data: Dict) -> Dict:
+        self.__message_id += 1
+
+        return {
+            "message_id": self.__message_id,
+            "date": int(time.time()),
+            "chat": {"id": data.get("chat_id", 0), "type": "private"},
+        }
+
+
+def echo_worker(results, index: int, workers: int, updates) -> None:
+    """
+    Worker of the supervisor that reports the updates routed to it, and exits on the ones marked to crash it.
+    The ones marked as pings are answered with the process ID of the worker instead
+    """
+    while True:
+        update = updates.get()
+
+        if update is None:
+            return
+
+        if update.get("crash"):
+            # Flushes the reports made so far, which would be lost along with the process otherwise
+            results.close()
+            results.join_thread()
+            os._exit(1)
+
+        if update.get("ping"):
+            results.put((index, os.getpid()))
+            continue
+
+        results.put((index, update["update_id"]))
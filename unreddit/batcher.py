@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from contextvars import Context
+from typing import Awaitable, Callable, Dict, Generic, Hashable, List, Optional, Tuple, Type, TypeVar
+
+from metrics import BATCH_SIZES
+from ratelimit import get_priority, prioritized
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class _Batch(Generic[K, V]):
+    __slots__ = ("futures", "timer", "priority")
+
+    def __init__(self):
+        self.futures: Dict[K, asyncio.Future] = {}
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.priority: Optional[int] = None
+
+
+class Batcher(Generic[K, V]):
+    """
+    Gathers the keys requested within `window` seconds of the first of them, up to `size` of them,
+    to load them all with a single call returning the values of the keys it has found.
+    The keys the call has not found, all of them when it fails, and a key left alone in its batch
+    are loaded by their own callers instead, one by one. The failures of the upstream itself, given as `errors`,
+    are shared by all the keys of the batch instead, as loading them one by one would only make matters worse.
+    The batch is loaded on behalf of all its callers, at the priority of the most urgent of them
+    """
+
+    def __init__(self, name: str, window: float, size: int, errors: Tuple[Type[Exception], ...] = ()):
+        self.name = name
+        self.window = window
+        self.size = size
+        self.errors = errors
+
+        self.__pending: Optional[_Batch[K, V]] = None
+
+    async def load(self, key: K, load_many: Callable[[List[K]], Awaitable[Dict[K, V]]],
+                   load_one: Callable[[], Awaitable[V]]) -> V:
+        if self.window <= 0 or self.size <= 1:
+            return await load_one()
+
+        batch = self.__pending
+
+        if batch is None:
+            batch = self.__pending = _Batch()
+            batch.timer = asyncio.get_event_loop().call_later(self.window, self.__flush, batch, load_many)
+
+        priority = get_priority()
+        batch.priority = priority if batch.priority is None else min(batch.priority, priority)
+
+        future = batch.futures.get(key)
+
+        if future is None:
+            future = batch.futures[key] = asyncio.get_event_loop().create_future()
+
+            if len(batch.futures) >= self.size:
+                self.__flush(batch, load_many)
+
+        # A cancelled caller must not cancel the load for the others
+        found, value = await asyncio.shield(future)
+
+        if not found:
+            return await load_one()
+
+        return value
+
+    def __flush(self, batch: _Batch[K, V], load_many: Callable[[List[K]], Awaitable[Dict[K, V]]]) -> None:
+        if self.__pending is batch:
+            self.__pending = None
+
+        batch.timer.cancel()
+        BATCH_SIZES.observe(len(batch.futures), upstream=self.name)
+
+        if len(batch.futures) == 1:
+            _resolve(batch, {})
+
+        else:
+            # Out of the context of the caller that has happened to open or fill the batch, such as its trace
+            Context().run(asyncio.ensure_future, self.__load(batch, load_many))
+
+    async def __load(self, batch: _Batch[K, V], load_many: Callable[[List[K]], Awaitable[Dict[K, V]]]) -> None:
+        try:
+            with prioritized(batch.priority):
+                values = await load_many(list(batch.futures))
+
+        except self.errors as e:
+            for future in batch.futures.values():
+                if not future.done():
+                    future.set_exception(e)
+
+            return
+
+        except Exception as e:
+            logging.getLogger().warning(f"Batch of {len(batch.futures)} {self.name} keys has failed to load: {e!r}")
+            values = {}
+
+        _resolve(batch, values)
+
+
+def _resolve(batch: _Batch[K, V], values: Dict[K, V]) -> None:
+    for key, future in batch.futures.items():
+        if not future.done():
+            future.set_result((key in values, values.get(key)))
+
+
+__all__ = ["Batcher"]
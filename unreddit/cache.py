@@ -0,0 +1,187 @@
+import logging
+import sqlite3
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+from storage import SqliteStore
+
+
+class LRUCache:
+    """
+    Bounded in-memory cache with least-recently-used eviction and optional per-entry expiration.
+    Expired entries are kept for `grace` seconds more, to be served stale while they are refreshed
+    """
+
+    def __init__(self, size: int, ttl: Optional[float] = None, grace: float = 0.0):
+        self.__size = size
+        self.__ttl = ttl
+        self.__grace = grace
+        self.__entries: "OrderedDict[Hashable, Tuple[Optional[float], Any]]" = OrderedDict()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, count=False) is not None
+
+    def get(self, key: Hashable, default: Any = None, count: bool = True) -> Any:
+        entry = self.__entries.get(key)
+
+        if entry is not None:
+            expires_at, value = entry
+            now = monotonic()
+
+            if expires_at is None or expires_at > now:
+                self.__entries.move_to_end(key)
+
+                if count:
+                    self.hits += 1
+
+                return value
+
+            if expires_at + self.__grace <= now:
+                del self.__entries[key]
+
+        if count:
+            self.misses += 1
+
+        return default
+
+    def get_stale(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Value of the entry even if it has expired, as long as it has done so less than `grace` seconds ago
+        """
+        entry = self.__entries.get(key)
+
+        if entry is not None:
+            expires_at, value = entry
+
+            if expires_at is None or expires_at + self.__grace > monotonic():
+                self.__entries.move_to_end(key)
+                self.stale_hits += 1
+
+                return value
+
+            del self.__entries[key]
+
+        return default
+
+    def put(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        if self.__size <= 0:
+            return
+
+        ttl = ttl if ttl is not None else self.__ttl
+
+        self.__entries[key] = (monotonic() + ttl if ttl is not None else None, value)
+        self.__entries.move_to_end(key)
+
+        while len(self.__entries) > self.__size:
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        _, value = self.__entries.pop(key, (None, default))
+        return value
+
+    def clear(self) -> None:
+        self.__entries.clear()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "size": len(self.__entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+class TieredCache:
+    """
+    In-memory cache backed by an optional persistent store for the entries that have to survive restarts.
+    The store is only read on memory misses, so it warms the memory up lazily after a restart.
+    The store is shared with the other workers, and the cache falls back to the memory alone whenever it is busy
+    """
+
+    def __init__(self, memory: LRUCache, store: Optional[SqliteStore] = None,
+                 dump: Callable[[Any], str] = _identity,
+                 load: Callable[[str], Any] = _identity):
+        self.memory = memory
+        self.store = store
+
+        self.__dump = dump
+        self.__load = load
+
+    def get(self, key: str) -> Any:
+        value = self.memory.get(key)
+
+        if value is None:
+            value = self.get_stored(key)
+
+            if value is not None:
+                self.memory.put(key, value)
+
+        return value
+
+    def get_stored(self, key: str) -> Any:
+        """
+        Value of the entry in the store alone, which may be as old as the store keeps its entries
+        """
+        if self.store is None:
+            return None
+
+        try:
+            stored = self.store.get(key)
+
+        except sqlite3.Error as e:
+            logging.getLogger().warning(f"Store has failed to get {key}: {e!r}")
+            return None
+
+        if stored is None:
+            return None
+
+        try:
+            return self.__load(stored)
+
+        except (ValueError, KeyError, TypeError):
+            self.pop(key)
+            return None
+
+    def put(self, key: str, value: Any) -> None:
+        self.memory.put(key, value)
+
+        if self.store is not None:
+            try:
+                self.store.put(key, self.__dump(value))
+
+            except sqlite3.Error as e:
+                logging.getLogger().warning(f"Store has failed to put {key}: {e!r}")
+
+    def pop(self, key: str) -> None:
+        self.memory.pop(key)
+
+        if self.store is not None:
+            try:
+                self.store.pop(key)
+
+            except sqlite3.Error as e:
+                logging.getLogger().warning(f"Store has failed to pop {key}: {e!r}")
+
+
+__all__ = ["LRUCache", "TieredCache"]
@@ -1,12 +1,13 @@
-from typing import List
+from typing import List, NamedTuple
 
 
-class Button:
-    def __init__(self, text: str, url: str):
-        self.text = text
-        self.url = url
+class Button(NamedTuple):
+    text: str
+    url: str
 
 
 class Metadata:
+    __slots__ = ()
+
     def get_buttons(self) -> List[Button]:
         return []
@@ -0,0 +1,63 @@
+from typing import Any, List, Tuple
+
+import ujson
+
+from .metadata import Button, Metadata
+from .types import Content, Text, Link, Image, Animation, Video, Album, _restore
+
+# Bumped on every incompatible change of the format, so that the stored entries are discarded
+SCHEMA_VERSION = 3
+
+CONTENT_TYPES = {cls.__name__: cls for cls in (Text, Link, Image, Animation, Video, Album)}
+
+
+class StoredMetadata(Metadata):
+    __slots__ = ("buttons",)
+
+    def __init__(self, buttons: List[Button]):
+        self.buttons = buttons
+
+    def get_buttons(self) -> List[Button]:
+        return self.buttons
+
+
+def dump_content(content: Content) -> List[Any]:
+    """
+    Compact form of the content: its type followed by the values of its fields
+    """
+    values = content.values()
+
+    if isinstance(content, Album):
+        payload = [dump_content(media) for media in content.payload]
+        values = (payload, *values[1:])
+
+    return [type(content).__name__, *values]
+
+
+def load_content(data: List[Any]) -> Content:
+    name, payload, *values = data
+    cls = CONTENT_TYPES[name]
+
+    if cls is Album:
+        payload = tuple(load_content(media) for media in payload)
+
+    # Sequences are stored as lists, but are tuples in the immutable content
+    values = tuple(tuple(value) if isinstance(value, list) else value for value in values)
+
+    return _restore(cls, (payload, *values))
+
+
+def dumps(result: Tuple[Content, Metadata]) -> str:
+    content, metadata = result
+
+    return ujson.dumps([dump_content(content), [list(button) for button in metadata.get_buttons()]],
+                       ensure_ascii=False)
+
+
+def loads(value: str) -> Tuple[Content, Metadata]:
+    content, buttons = ujson.loads(value)
+
+    return load_content(content), StoredMetadata([Button(text, url) for text, url in buttons])
+
+
+__all__ = ["SCHEMA_VERSION", "StoredMetadata", "dumps", "loads"]
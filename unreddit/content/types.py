@@ -1,4 +1,5 @@
-from typing import Union, List, Optional
+from html import escape
+from typing import Union, List, Optional, Sequence, Tuple, Any
 
 
 def trim_text(text: str, limit=1024) -> str:
@@ -21,83 +22,124 @@ def trim_text(text: str, limit=1024) -> str:
 
 
 class Content:
-    @property
-    def payload(self) -> Union[None, str, List["Content"]]:
-        return self.__payload
+    """
+    Immutable, so that the loaded content can be cached and shared between the replies.
+    Use `replace` to get a changed copy
+    """
 
-    @property
-    def caption(self) -> str:
-        return self.__caption
+    __slots__ = ("payload", "caption")
 
-    @caption.setter
-    def caption(self, value: str) -> None:
-        self.__caption = value
+    # Names of all the slots of the class, in the order of the declaration
+    fields: Tuple[str, ...] = __slots__
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.fields = cls.__base__.fields + tuple(cls.__dict__.get("__slots__", ()))
 
     def __init__(self, payload: Union[None, str, List["Content"]] = None,
                  caption: Optional[str] = None):
-        self.__payload = payload
-        self.__caption = caption
+        self._set(payload=tuple(payload) if isinstance(payload, list) else payload,
+                  caption=caption)
 
+    def _set(self, **fields) -> None:
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
 
-class Text(Content):
-    @property
-    def parse_mode(self) -> Optional[str]:
-        return self.__parse_mode
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable, use replace() instead")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __copy__(self) -> "Content":
+        return self
+
+    def __deepcopy__(self, memo) -> "Content":
+        return self
+
+    def __reduce__(self):
+        return _restore, (type(self), self.values())
+
+    def __eq__(self, other: Any) -> bool:
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __hash__(self) -> int:
+        return hash((type(self), self.values()))
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({', '.join(f'{name}={getattr(self, name)!r}' for name in self.fields)})"
+
+    def values(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.fields)
+
+    def replace(self, **changes) -> "Content":
+        values = tuple(changes.pop(name, getattr(self, name)) for name in self.fields)
+
+        if changes:
+            raise TypeError(f"{type(self).__name__} has no fields {', '.join(changes)}")
+
+        return _restore(type(self), values)
 
-    @parse_mode.setter
-    def parse_mode(self, value: str) -> None:
-        self.__parse_mode = value
+
+def _restore(cls: type, values: tuple) -> Content:
+    """
+    Builds the content from the final values of its fields, bypassing the constructors
+    """
+    content = object.__new__(cls)
+
+    for name, value in zip(cls.fields, values):
+        object.__setattr__(content, name, value)
+
+    return content
+
+
+class Text(Content):
+    __slots__ = ("parse_mode",)
 
     def __init__(self, text: Optional[str], parse_mode=None):
         if text is not None:
             text = trim_text(text)
 
         super().__init__(payload=text, caption=text)
-        self.__parse_mode = parse_mode
+        self._set(parse_mode=parse_mode)
 
 
 class Link(Text):
+    __slots__ = ()
+
     def __init__(self, content_url: str, caption: str, icon: str = "🔗"):
-        super().__init__(f"<a href=\"{content_url}\">{icon}</a> {caption}")
-        self.parse_mode = "html"
-        self.caption = caption
+        # Titles and URLs come unescaped from the upstreams
+        super().__init__(f"<a href=\"{escape(content_url)}\">{icon}</a> {escape(caption or '')}", parse_mode="html")
+        self._set(caption=caption)
 
 
 class Media(Content):
-    @property
-    def icon(self) -> Optional[str]:
-        return self.__icon
-
-    @property
-    def fallback(self) -> Optional[str]:
-        return self.__fallback
+    # Alternative URLs of the same media, from the best to the worst, to fall back on when the payload is too much
+    __slots__ = ("icon", "fallback", "thumbnail", "renditions")
 
     @property
     def descriptor(self) -> Optional[str]:
         return type(self).__name__.lower()
 
-    @property
-    def thumbnail(self) -> Optional[str]:
-        return self.__thumbnail
-
     def __init__(self, icon: str,
                  payload: Union[None, str, List["Media"]] = None,
                  fallback: Optional[str] = None,
                  caption: Optional[str] = None,
-                 thumbnail: Optional[str] = None):
+                 thumbnail: Optional[str] = None,
+                 renditions: Sequence[str] = ()):
         super().__init__(payload=payload, caption=caption)
 
-        self.__icon = icon
-        self.__fallback = fallback
-        self.__thumbnail = thumbnail
+        self._set(icon=icon, fallback=fallback, thumbnail=thumbnail, renditions=tuple(renditions))
 
     def get_embed_fallback_message(self):
-        return f"<a href=\"{self.fallback}\">{self.icon} {self.caption}</a>" \
+        return f"<a href=\"{escape(self.fallback)}\">{self.icon} {escape(self.caption or '')}</a>" \
                f"\n\n" \
                f"[Telegram wasn't able to embed the {self.descriptor}]"
 
 
 class Album(Media):
+    __slots__ = ()
+
     def __init__(self, media: List[Media], fallback_url: str, caption: Optional[str]):
         super().__init__("🔗",
                          payload=media,
@@ -106,24 +148,36 @@ class Album(Media):
 
 
 class Animation(Media):
-    def __init__(self, content_url: str, thumbnail_url: Optional[str], caption: Optional[str]):
+    __slots__ = ()
+
+    def __init__(self, content_url: str, thumbnail_url: Optional[str], caption: Optional[str],
+                 renditions: Sequence[str] = ()):
         super().__init__("🎬", payload=content_url,
                          fallback=content_url,
                          caption=caption,
-                         thumbnail=thumbnail_url)
+                         thumbnail=thumbnail_url,
+                         renditions=renditions)
 
 
 class Video(Media):
-    def __init__(self, content_url: str, thumbnail_url: Optional[str], caption: Optional[str]):
+    __slots__ = ()
+
+    def __init__(self, content_url: str, thumbnail_url: Optional[str], caption: Optional[str],
+                 renditions: Sequence[str] = ()):
         super().__init__("🎬", payload=content_url,
                          fallback=content_url,
                          caption=caption,
-                         thumbnail=thumbnail_url)
+                         thumbnail=thumbnail_url,
+                         renditions=renditions)
 
 
 class Image(Media):
-    def __init__(self, content_url: str, thumbnail_url: Optional[str], caption: Optional[str]):
+    __slots__ = ()
+
+    def __init__(self, content_url: str, thumbnail_url: Optional[str], caption: Optional[str],
+                 renditions: Sequence[str] = ()):
         super().__init__("🖼", payload=content_url,
                          fallback=content_url,
                          caption=caption,
-                         thumbnail=thumbnail_url or content_url)
+                         thumbnail=thumbnail_url or content_url,
+                         renditions=renditions)
@@ -0,0 +1,21 @@
+from .imgur import ImgurLoader
+from .loader import ContentLoader, MediaNotFoundError
+from .reddit import RedditLoader
+from .registry import LOADERS, register_loader, register_lazy_loader, get_loader
+
+# Gfycat is gone, its links are only left in the older posts
+register_lazy_loader("gfycat", ("gfycat.com",), ".gfycat")
+
+
+def __getattr__(name: str):
+    if name == "GfyCatLoader":
+        return get_loader("gfycat")
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = [
+    "ContentLoader", "MediaNotFoundError",
+    "GfyCatLoader", "ImgurLoader", "RedditLoader",
+    "LOADERS", "register_loader", "register_lazy_loader", "get_loader"
+]
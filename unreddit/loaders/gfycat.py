@@ -1,29 +1,37 @@
-import re
 from os import getenv
-from typing import Tuple, Dict
+from typing import Tuple, Dict, List, Optional
 
 from content import Metadata, Content, Animation, Video
-from url_utils import get_path
-from .loader import ContentLoader
+from url_utils import LinkDescriptor
+from .loader import ContentLoader, MEDIA_CACHE
+from .registry import register_loader
 
-GFYCAT_REGEXP = re.compile(r"gfycat\.com")
 GFYCAT_API_URL_DEFAULT = "https://api.gfycat.com"
 GFYCAT_API_URL_KEY = "GFYCAT_API_URL"
 
 
 class GfyCatLoader(ContentLoader):
+    upstream = "gfycat"
+    hosts = ("gfycat.com",)
+    concurrency = 8
+    cache = MEDIA_CACHE
+
+    @staticmethod
+    def classify(url: str, path: List[str]) -> Optional[LinkDescriptor]:
+        if not path:
+            return None
+
+        post_id, *_ = path[-1].split("-")
+        return LinkDescriptor(url, "gfycat", "media", post_id=post_id)
+
     def get_api_url(self) -> str:
         return getenv(GFYCAT_API_URL_KEY, GFYCAT_API_URL_DEFAULT)
 
-    async def get_headers(self) -> Dict[str, str]:
+    def get_headers(self) -> Dict[str, str]:
         return {}
 
-    async def load(self, url: str) -> Tuple[Content, Metadata]:
-        path = get_path(url)
-
-        post_id, *_ = path[1:].split("-")
-
-        data = await self._load(f"{self.get_api_url()}/v1/gfycats/{post_id}")
+    async def load_post(self, link: LinkDescriptor) -> Tuple[Content, Metadata]:
+        data = await self._load(f"{self.get_api_url()}/v1/gfycats/{link.post_id}")
 
         title = data["gfyItem"]["title"] or None
         thumbnail_url = data["gfyItem"]["thumb100PosterUrl"]
@@ -35,7 +43,9 @@ class GfyCatLoader(ContentLoader):
 
 
 class GfyCatMetadata(Metadata):
-    pass
+    __slots__ = ()
+
 
+register_loader(GfyCatLoader)
 
-__all__ = ["GFYCAT_REGEXP", "GfyCatLoader"]
+__all__ = ["GfyCatLoader"]
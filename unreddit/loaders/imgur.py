@@ -1,12 +1,11 @@
-import re
 from os import getenv
-from typing import Tuple, Optional
+from typing import Tuple, Optional, List
 
 from content import *
-from url_utils import get_path
-from .loader import ContentLoader
+from url_utils import LinkDescriptor
+from .loader import ContentLoader, MEDIA_CACHE
+from .registry import register_loader
 
-IMGUR_REGEXP = re.compile(r"imgur\.com")
 IMGUR_API_URL_DEFAULT = "https://api.imgur.com"
 IMGUR_API_URL_KEY = "IMGUR_API_URL"
 
@@ -35,19 +34,31 @@ def _from_gallery_item(image) -> Optional[Media]:
 
 
 class ImgurLoader(ContentLoader):
+    upstream = "imgur"
+    hosts = ("imgur.com",)
+    concurrency = 16
+    cache = MEDIA_CACHE
+
+    @staticmethod
+    def classify(url: str, path: List[str]) -> Optional[LinkDescriptor]:
+        if len(path) > 1 and path[0] in ("gallery", "a"):
+            return LinkDescriptor(url, "imgur", "album", post_id=path[-1])
+
+        elif path:
+            post_id, *_ = path[0].split(".")
+            return LinkDescriptor(url, "imgur", "image", post_id=post_id)
+
+        return None
+
     def get_api_url(self) -> str:
         return getenv(IMGUR_API_URL_KEY, IMGUR_API_URL_DEFAULT)
 
     def get_headers(self):
         return {"Authorization": f"Client-ID {getenv('IMGUR_CLIENT_ID')}"}
 
-    async def load(self, url: str) -> Tuple[Content, Metadata]:
-        path = get_path(url)
-
-        if re.match(r"/gallery/\w+", path):
-            *_, post_id = path.split("/")
-
-            data = await self._load(f"{self.get_api_url()}/3/album/{post_id}")
+    async def load_post(self, link: LinkDescriptor) -> Tuple[Content, Metadata]:
+        if link.kind == "album":
+            data = await self._load(f"{self.get_api_url()}/3/album/{link.post_id}")
 
             title = data["data"]["title"] or None
             media = []
@@ -58,12 +69,10 @@ class ImgurLoader(ContentLoader):
                 if item is not None:
                     media.append(item)
 
-            return Album(media, url, title), ImgurMetadata()
+            return Album(media, link.url, title), ImgurMetadata()
 
         else:
-            post_id, *_ = path[1:].split(".")
-
-            data = await self._load(f"{self.get_api_url()}/3/image/{post_id}")
+            data = await self._load(f"{self.get_api_url()}/3/image/{link.post_id}")
 
             title = data["data"]["title"] or None
 
@@ -78,7 +87,9 @@ class ImgurLoader(ContentLoader):
 
 
 class ImgurMetadata(Metadata):
-    pass
+    __slots__ = ()
+
 
+register_loader(ImgurLoader)
 
-__all__ = ["IMGUR_REGEXP", "ImgurLoader"]
+__all__ = ["ImgurLoader"]
@@ -1,41 +1,367 @@
+import asyncio
+import itertools
+import logging
 from abc import abstractmethod
-from typing import Tuple, Any, Dict
+from contextlib import asynccontextmanager
+from contextvars import Context, ContextVar
+from os import getenv
+from typing import Tuple, Any, AsyncIterator, Dict, Awaitable, Callable, List, Optional, Type
 
 import ujson
-from aiohttp import ClientSession
+from aiohttp import ClientResponse, ClientResponseError, ClientSession
 
+from cache import LRUCache, TieredCache
 from content import Content, Metadata
+from content.serialization import SCHEMA_VERSION, dumps, loads
+from metrics import IN_FLIGHT_REQUESTS, LOAD_RESULTS, LOAD_SECONDS, PHASE_SECONDS, UPSTREAM_RESPONSES, register_cache
+from ratelimit import REVALIDATION_PRIORITY, get_rate_limiter, get_retries, prioritized
+from sessions import SESSIONS
+from singleflight import SingleFlight
+from storage import SqliteStore
+from tracing import span
+from url_utils import LinkDescriptor, classify_url, normalize_url
+
+CONTENT_CACHE_PATH_KEY = "CONTENT_CACHE_PATH"
+CONTENT_CACHE_SIZE_DEFAULT = 100000
+CONTENT_CACHE_SIZE_KEY = "CONTENT_CACHE_SIZE"
+CONTENT_CACHE_TTL_DEFAULT = 3600
+CONTENT_CACHE_TTL_KEY = "CONTENT_CACHE_TTL"
+CONTENT_CACHE_GRACE_DEFAULT = 600
+CONTENT_CACHE_GRACE_KEY = "CONTENT_CACHE_GRACE"
+MEDIA_CACHE_SIZE_DEFAULT = 1024
+MEDIA_CACHE_SIZE_KEY = "MEDIA_CACHE_SIZE"
+MEDIA_CACHE_TTL_DEFAULT = 3600
+MEDIA_CACHE_TTL_KEY = "MEDIA_CACHE_TTL"
+NEGATIVE_CACHE_SIZE_DEFAULT = 4096
+NEGATIVE_CACHE_SIZE_KEY = "NEGATIVE_CACHE_SIZE"
+NOT_MEDIA_CACHE_TTL_DEFAULT = 600
+NOT_MEDIA_CACHE_TTL_KEY = "NOT_MEDIA_CACHE_TTL"
+NOT_FOUND_CACHE_TTL_DEFAULT = 300
+NOT_FOUND_CACHE_TTL_KEY = "NOT_FOUND_CACHE_TTL"
+UPSTREAM_ERROR_CACHE_TTL_DEFAULT = 30
+UPSTREAM_ERROR_CACHE_TTL_KEY = "UPSTREAM_ERROR_CACHE_TTL"
+VALIDATOR_CACHE_SIZE_DEFAULT = 4096
+VALIDATOR_CACHE_SIZE_KEY = "VALIDATOR_CACHE_SIZE"
+CONCURRENCY_KEY = "{}_CONCURRENCY"
+
+# Identical upstream requests in progress at the same time are made only once
+IN_FLIGHT = SingleFlight()
+
+# Loaded content shared by all the loaders, that survives restarts
+CONTENT_STORE = SqliteStore(getenv(CONTENT_CACHE_PATH_KEY), "content",
+                            version=SCHEMA_VERSION,
+                            size=int(getenv(CONTENT_CACHE_SIZE_KEY, CONTENT_CACHE_SIZE_DEFAULT)),
+                            ttl=float(getenv(CONTENT_CACHE_TTL_KEY, CONTENT_CACHE_TTL_DEFAULT))) \
+    if getenv(CONTENT_CACHE_PATH_KEY) else None
+
+
+def content_cache(size: int, ttl: float) -> TieredCache:
+    grace = float(getenv(CONTENT_CACHE_GRACE_KEY, CONTENT_CACHE_GRACE_DEFAULT))
+    return TieredCache(LRUCache(size, ttl, grace), CONTENT_STORE, dump=dumps, load=loads)
+
+
+# Content of the media hosts the posts link to
+MEDIA_CACHE = content_cache(int(getenv(MEDIA_CACHE_SIZE_KEY, MEDIA_CACHE_SIZE_DEFAULT)),
+                            float(getenv(MEDIA_CACHE_TTL_KEY, MEDIA_CACHE_TTL_DEFAULT)))
+
+register_cache("media", MEDIA_CACHE.memory)
+
+# Links known to produce no reply, mapped to the reason why, so that they are not loaded again for a while
+NEGATIVE_CACHE = LRUCache(int(getenv(NEGATIVE_CACHE_SIZE_KEY, NEGATIVE_CACHE_SIZE_DEFAULT)))
+NEGATIVE_CACHE_TTLS = {
+    "not_media": float(getenv(NOT_MEDIA_CACHE_TTL_KEY, NOT_MEDIA_CACHE_TTL_DEFAULT)),
+    "not_found": float(getenv(NOT_FOUND_CACHE_TTL_KEY, NOT_FOUND_CACHE_TTL_DEFAULT)),
+    "upstream_error": float(getenv(UPSTREAM_ERROR_CACHE_TTL_KEY, UPSTREAM_ERROR_CACHE_TTL_DEFAULT)),
+}
+
+register_cache("negative", NEGATIVE_CACHE)
+
+# ETag and Last-Modified of the upstream responses, by normalized URL, to revalidate the cached content with
+VALIDATORS = LRUCache(int(getenv(VALIDATOR_CACHE_SIZE_KEY, VALIDATOR_CACHE_SIZE_DEFAULT)))
+
+# Keys of the cached content being refreshed in the background
+_revalidations: Dict[str, asyncio.Future] = {}
+
+# Loader refreshing its cached content, whose requests are made conditional
+_revalidating: ContextVar[Optional["ContentLoader"]] = ContextVar("revalidating", default=None)
 
 
 class MediaNotFoundError(Exception):
     pass
 
 
+class NotModifiedError(Exception):
+    pass
+
+
+def _get_failure_reason(error: Exception) -> Optional[str]:
+    if isinstance(error, MediaNotFoundError):
+        return "not_media"
+
+    if isinstance(error, ClientResponseError) and error.status in (403, 404, 410):
+        return "not_found"
+
+    if isinstance(error, ClientResponseError) and error.status >= 500:
+        return "upstream_error"
+
+    return None
+
+
+def _remember_failure(key: str, error: Exception) -> None:
+    reason = _get_failure_reason(error)
+
+    if reason is not None:
+        NEGATIVE_CACHE.put(key, reason, NEGATIVE_CACHE_TTLS[reason])
+
+
+_semaphores: Dict[Type["ContentLoader"], asyncio.Semaphore] = {}
+
+
 class ContentLoader:
+    # Name of the site the loader handles the links to, and of the connection pool its requests go through
+    upstream: str = None
+
+    # Hosts the links to are classified by `classify` (along with their subdomains)
+    hosts: Tuple[str, ...] = ()
+
+    # Maximum number of links of the site loaded at the same time
+    concurrency: int = 16
+
+    # Where the loaded content is kept, if anywhere
+    cache: Optional[TieredCache] = None
+
+    @staticmethod
+    def classify(url: str, path: List[str]) -> Optional[LinkDescriptor]:
+        return None
+
+    @classmethod
+    def get_semaphore(cls) -> asyncio.Semaphore:
+        semaphore = _semaphores.get(cls)
+
+        if semaphore is None:
+            semaphore = _semaphores[cls] = asyncio.Semaphore(
+                int(getenv(CONCURRENCY_KEY.format(cls.upstream.upper()), cls.concurrency))
+            )
+
+        return semaphore
+
     def __init__(self, session: ClientSession = None, parent: "ContentLoader" = None):
         if session is not None:
             self.__session = session
         elif parent is not None:
-            self.__session = parent.__session
+            self.__session = SESSIONS.get(self.upstream) or parent.__session
         else:
             raise ValueError()
 
+        # Set by the loads that have made do without some part of the content, which is soon to be loaded again
+        self._degraded = False
+
     @abstractmethod
     def get_api_url(self) -> str:
         pass
 
     @abstractmethod
-    async def get_headers(self) -> Dict[str, str]:
+    def get_headers(self) -> Dict[str, str]:
         pass
 
     @abstractmethod
-    async def load(self, url: str) -> Tuple[Content, Metadata]:
+    async def load_post(self, link: LinkDescriptor) -> Tuple[Content, Metadata]:
         pass
 
+    def get_cache_key(self, link: LinkDescriptor) -> str:
+        return f"{link.site}:{link.kind}:{link.post_id}:{link.comment_id or ''}"
+
+    async def load(self, url: str) -> Tuple[Content, Metadata]:
+        link = classify_url(url)
+
+        if link is None or link.site != self.upstream:
+            raise MediaNotFoundError
+
+        return await self.load_link(link)
+
+    async def load_link(self, link: LinkDescriptor) -> Tuple[Content, Metadata]:
+        loader = type(self).__name__
+        key = self.get_cache_key(link)
+
+        reason = NEGATIVE_CACHE.get(key)
+
+        if reason is not None:
+            LOAD_RESULTS.inc(loader=loader, result=f"cached_{reason}")
+            raise MediaNotFoundError
+
+        try:
+            with LOAD_SECONDS.time(loader=loader), span("load", loader=loader, url=link.url):
+                if self.cache is None:
+                    result = await self.__load_post(link)
+
+                else:
+                    result = await self._cached(self.cache, key, lambda: self.__load_post(link))
+
+        except Exception as e:
+            LOAD_RESULTS.inc(loader=loader, result=_get_failure_reason(e) or "error")
+            _remember_failure(key, e)
+            raise
+
+        LOAD_RESULTS.inc(loader=loader, result="ok")
+
+        return result
+
+    async def __load_post(self, link: LinkDescriptor) -> Tuple[Content, Metadata]:
+        async with self.get_semaphore():
+            return await self.load_post(link)
+
+    async def _cached(self, cache: TieredCache, key: str,
+                      load: Callable[[], Awaitable[Tuple[Content, Metadata]]]) -> Tuple[Content, Metadata]:
+        result = cache.memory.get(key)
+
+        if result is not None:
+            return result
+
+        result = cache.memory.get_stale(key)
+
+        if result is None:
+            # The store keeps the content for longer than the memory does, and may have it from another worker,
+            # so that it is no fresher than a stale entry
+            result = cache.get_stored(key)
+
+            if result is not None:
+                cache.memory.put(key, result, ttl=0)
+
+        if result is not None:
+            # Served as it is, and refreshed for the next time
+            self.__revalidate(cache, key, result, load)
+            return result
+
+        self._degraded = False
+        result = await load()
+
+        if result is not None:
+            self.__put(cache, key, result)
+
+        return result
+
+    def __put(self, cache: TieredCache, key: str, result: Tuple[Content, Metadata]) -> None:
+        if self._degraded:
+            # Kept only as long as the failure it makes do without, and not for the other workers
+            cache.memory.put(key, result, NEGATIVE_CACHE_TTLS["upstream_error"])
+
+        else:
+            cache.put(key, result)
+
+    def __revalidate(self, cache: TieredCache, key: str, stale: Tuple[Content, Metadata],
+                     load: Callable[[], Awaitable[Tuple[Content, Metadata]]]) -> None:
+        if key in _revalidations:
+            return
+
+        # Out of the context of the update, which the refresh outlives
+        refresh = Context().run(asyncio.ensure_future, self.__refresh(cache, key, stale, load))
+        _revalidations[key] = refresh
+        refresh.add_done_callback(lambda _: _revalidations.pop(key, None))
+
+    async def __refresh(self, cache: TieredCache, key: str, stale: Tuple[Content, Metadata],
+                        load: Callable[[], Awaitable[Tuple[Content, Metadata]]]) -> None:
+        _revalidating.set(self)
+        self._degraded = False
+
+        try:
+            with prioritized(REVALIDATION_PRIORITY):
+                result = await load()
+
+        except NotModifiedError:
+            result = stale
+
+        except Exception as e:
+            if _get_failure_reason(e) in ("not_media", "not_found"):  # the post is gone
+                cache.pop(key)
+                _remember_failure(key, e)
+
+            else:
+                logging.getLogger().warning(f"{key} has failed to revalidate: {e!r}")
+
+            return
+
+        if result is not None:
+            self.__put(cache, key, result)
+
     async def _resolve_redirect(self, url: str) -> str:
-        async with self.__session.head(url, headers=self.get_headers(), raise_for_status=True, allow_redirects=False) as response:
-            return response.headers.get("Location")
+        return await IN_FLIGHT.do(("HEAD", normalize_url(url)), lambda: self.__resolve_redirect(url))
 
     async def _load(self, url: str) -> Any:
-        async with self.__session.get(url, headers=self.get_headers(), raise_for_status=True) as response:
-            return await response.json(loads=ujson.loads)
+        headers = self.__get_conditional_headers(url)
+
+        # A conditional request may be answered with 304, which only the revalidation has something to make do with
+        return await IN_FLIGHT.do(("GET", normalize_url(url), tuple(sorted(headers.items()))),
+                                  lambda: self.__load(url, headers))
+
+    @asynccontextmanager
+    async def __request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None,
+                        **kwargs) -> AsyncIterator[ClientResponse]:
+        """
+        Waits for the rate limit of the upstream, and once more for every time the upstream answers
+        with 429 Too Many Requests, up to the configured number of retries
+        """
+        limiter = get_rate_limiter(self.upstream)
+        headers = {**self.get_headers(), **(headers or {})}
+
+        for attempt in itertools.count():
+            await limiter.acquire()
+
+            with IN_FLIGHT_REQUESTS.track(upstream=self.upstream):
+                async with self.__session.request(method, url, headers=headers, **kwargs) as response:
+                    UPSTREAM_RESPONSES.inc(upstream=self.upstream, status=response.status)
+                    limiter.update(response.status, response.headers)
+
+                    if response.status == 429 and attempt < get_retries():
+                        continue
+
+                    response.raise_for_status()
+
+                    yield response
+                    return
+
+    async def __resolve_redirect(self, url: str) -> str:
+        with PHASE_SECONDS.time(loader=type(self).__name__, phase="redirect"), span("redirect", url=url):
+            async with self.__request("HEAD", url, allow_redirects=False) as response:
+                return response.headers.get("Location")
+
+    async def __load(self, url: str, headers: Dict[str, str]) -> Any:
+        loader = type(self).__name__
+
+        with PHASE_SECONDS.time(loader=loader, phase="fetch"), span("fetch", url=url) as fetch:
+            async with self.__request("GET", url, headers=headers) as response:
+                if response.status == 304:
+                    raise NotModifiedError
+
+                self.__remember_validators(url, response)
+
+                body = await response.read()
+
+            if fetch is not None:
+                fetch.attributes["bytes"] = len(body)
+
+        with PHASE_SECONDS.time(loader=loader, phase="parse"), span("parse"):
+            return ujson.loads(body)
+
+    def __get_conditional_headers(self, url: str) -> Dict[str, str]:
+        # Only the refreshed loader's own requests can be answered with 304, the loaders it calls have nothing to reuse
+        if _revalidating.get() is not self:
+            return {}
+
+        etag, last_modified = VALIDATORS.get(normalize_url(url), (None, None))
+        headers = {}
+
+        if etag:
+            headers["If-None-Match"] = etag
+
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        return headers
+
+    @staticmethod
+    def __remember_validators(url: str, response: ClientResponse) -> None:
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+
+        if etag or last_modified:
+            VALIDATORS.put(normalize_url(url), (etag, last_modified))
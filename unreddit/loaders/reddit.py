@@ -1,24 +1,112 @@
+import asyncio
 import re
 from os import getenv
-from typing import Dict, List, Tuple, Union
+from typing import Any, Dict, List, Tuple, Union, Optional
 
 from aiohttp import ClientError
 
+from batcher import Batcher
+from cache import LRUCache, TieredCache
 from content import *
-from url_utils import repath_url, get_path
-from .gfycat import GFYCAT_REGEXP, GfyCatLoader
-from .imgur import IMGUR_REGEXP, ImgurLoader
-from .loader import ContentLoader, MediaNotFoundError
+from metrics import register_cache
+from storage import SqliteStore
+from url_utils import LinkDescriptor, classify_url, repath_url, get_path
+from .imgur import ImgurLoader
+from .loader import ContentLoader, MediaNotFoundError, content_cache
+from .registry import get_loader, register_loader
 
-REDDIT_REGEXP = re.compile(r"reddit\.com(/(r|u|user)/\w+/|/)(comments|s)")
 REDDIT_API_URL_DEFAULT = "https://www.reddit.com"
 REDDIT_API_URL_KEY = "REDDIT_API_URL"
+REDDIT_CACHE_SIZE_DEFAULT = 1024
+REDDIT_CACHE_SIZE_KEY = "REDDIT_CACHE_SIZE"
+REDDIT_CACHE_TTL_DEFAULT = 300
+REDDIT_CACHE_TTL_KEY = "REDDIT_CACHE_TTL"
+REDDIT_BATCH_WINDOW_DEFAULT = 0.01
+REDDIT_BATCH_WINDOW_KEY = "REDDIT_BATCH_WINDOW"
+REDDIT_BATCH_SIZE_DEFAULT = 100
+REDDIT_BATCH_SIZE_KEY = "REDDIT_BATCH_SIZE"
+
+# Host of the buttons linking back to Reddit, whichever host the link has been sent with
+REDDIT_URL = "https://www.reddit.com"
+
+SHARE_CACHE_SIZE_DEFAULT = 4096
+SHARE_CACHE_SIZE_KEY = "SHARE_CACHE_SIZE"
+SHARE_CACHE_PATH_KEY = "SHARE_CACHE_PATH"
+
+REDDIT_CACHE = content_cache(int(getenv(REDDIT_CACHE_SIZE_KEY, REDDIT_CACHE_SIZE_DEFAULT)),
+                             float(getenv(REDDIT_CACHE_TTL_KEY, REDDIT_CACHE_TTL_DEFAULT)))
+
+# Share tokens never change their target, so their permalinks are kept without expiration
+SHARE_CACHE = TieredCache(LRUCache(int(getenv(SHARE_CACHE_SIZE_KEY, SHARE_CACHE_SIZE_DEFAULT))),
+                          SqliteStore(getenv(SHARE_CACHE_PATH_KEY), "share_links")
+                          if getenv(SHARE_CACHE_PATH_KEY) else None)
+
+register_cache("reddit", REDDIT_CACHE.memory)
+register_cache("share", SHARE_CACHE.memory)
+
+# Posts requested at about the same time, loaded with a single request
+POST_BATCHER = Batcher("reddit", float(getenv(REDDIT_BATCH_WINDOW_KEY, REDDIT_BATCH_WINDOW_DEFAULT)),
+                       int(getenv(REDDIT_BATCH_SIZE_KEY, REDDIT_BATCH_SIZE_DEFAULT)),
+                       errors=(ClientError, asyncio.TimeoutError))
+
+# Narrowest preview still worth sending in place of the original
+MIN_RENDITION_WIDTH = 320
+
+# Heights Reddit encodes its videos in, alongside the one of the fallback URL
+VIDEO_HEIGHTS = (1080, 720, 480, 360, 240)
+
+
+def _get_renditions(resolutions: List[Dict], url_key: str = "url", width_key: str = "width") -> List[str]:
+    """
+    URLs of the previews, from the widest to the narrowest
+    """
+    return [resolution[url_key]
+            for resolution in sorted(resolutions, key=lambda resolution: resolution[width_key], reverse=True)
+            if resolution[width_key] >= MIN_RENDITION_WIDTH]
 
 
 class RedditLoader(ContentLoader):
-    def is_comment_url(self, url):
-        path = [part for part in get_path(url).split("/") if part]
-        return len(path) == 6 or len(path) == 4
+    upstream = "reddit"
+    hosts = ("reddit.com",)
+    concurrency = 32
+    cache = REDDIT_CACHE
+
+    @staticmethod
+    def classify(url: str, path: List[str]) -> Optional[LinkDescriptor]:
+        """
+        Canonical identity of the post (and of the comment for the comment links),
+        independent of the host, the slug and the query parameters of the link
+        """
+        if path and path[0] in ("r", "u", "user"):
+            path = path[2:]
+
+        if len(path) < 2:
+            return None
+
+        if path[0] == "comments":
+            post_id = path[1].lower()
+            comment_id = path[3].lower() if len(path) > 3 else None
+
+            return LinkDescriptor(url, "reddit", "comment" if comment_id else "post",
+                                  post_id=post_id, comment_id=comment_id)
+
+        elif path[0] == "s":  # is an opaque share link
+            return LinkDescriptor(url, "reddit", "share", share_token=path[1])
+
+        return None
+
+    def get_json_url(self, link: LinkDescriptor) -> str:
+        """
+        Only the requested part of the thread: the post alone, or the post and the linked comment without replies
+        """
+        if link.kind == "post":
+            return self.get_posts_url([link.post_id])
+
+        return repath_url(self.get_api_url(), get_path(link.url)) + ".json?raw_json=1&context=0&depth=1&limit=1"
+
+    def get_posts_url(self, post_ids: List[str]) -> str:
+        names = ",".join(f"t3_{post_id}" for post_id in post_ids)
+        return f"{self.get_api_url()}/by_id/{names}.json?raw_json=1"
 
     def get_api_url(self):
         return getenv(REDDIT_API_URL_KEY, REDDIT_API_URL_DEFAULT)
@@ -26,23 +114,52 @@ class RedditLoader(ContentLoader):
     def get_headers(self):
         return {"User-agent": getenv("REDDIT_USER_AGENT")}
 
-    async def load(self, url: str) -> Tuple[Content, Metadata]:
-        match = REDDIT_REGEXP.search(url)
+    async def load_link(self, link: LinkDescriptor) -> Tuple[Content, Metadata]:
+        if link.kind == "share":
+            link = classify_url(await self.resolve_share_link(link) or "")
 
-        if not match:
-            raise MediaNotFoundError
+            if link is None or link.site != "reddit" or link.kind == "share":
+                raise MediaNotFoundError
+
+        return await super().load_link(link)
+
+    async def resolve_share_link(self, link: LinkDescriptor) -> Optional[str]:
+        permalink = SHARE_CACHE.get(link.share_token)
+
+        if permalink is None:
+            permalink = await self._resolve_redirect(repath_url(self.get_api_url(), get_path(link.url)))
+
+            if permalink:
+                SHARE_CACHE.put(link.share_token, permalink)
+
+        return permalink
+
+    async def load_posts(self, post_ids: List[str]) -> Dict[str, Any]:
+        """
+        Listings of the posts, each of them as it would be loaded alone, by the ids of the posts Reddit has found
+        """
+        data = await self._load(self.get_posts_url(post_ids))
+
+        return {child["data"]["id"]: {"kind": "Listing", "data": {"children": [child]}}
+                for child in data["data"]["children"]}
 
-        if 's' in match.groups():  # is an opaque share link
-            url = await self._resolve_redirect(url)
+    async def load_post(self, link: LinkDescriptor) -> Tuple[Content, Metadata]:
+        is_comment = link.kind == "comment"
 
-        is_comment = self.is_comment_url(url)
+        if is_comment:
+            op, comments = await self._load(self.get_json_url(link))
 
-        op, comments = await self._load(repath_url(self.get_api_url(), get_path(url)) + ".json")
+        else:
+            op, comments = await POST_BATCHER.load(link.post_id, self.load_posts,
+                                                   lambda: self._load(self.get_json_url(link))), None
+
+        if not op["data"]["children"]:
+            raise MediaNotFoundError
 
         post_data = op["data"]["children"][0]["data"]
 
         title = post_data.get("title", None)
-        metadata = RedditMetadata(url, post_data)
+        metadata = RedditMetadata(post_data)
 
         if "crosspost_parent_list" in post_data:
             post_data = post_data["crosspost_parent_list"][0]
@@ -53,8 +170,9 @@ class RedditLoader(ContentLoader):
 
         is_reddit_media = post_data.get("is_reddit_media_domain", False)
         is_gallery = post_data.get("gallery_data") is not None
-        is_link_to_imgur = IMGUR_REGEXP.search(post_data['url']) is not None
-        is_link_to_gfycat = GFYCAT_REGEXP.search(post_data['url']) is not None
+        linked = classify_url(post_data["url"])
+        is_link_to_imgur = linked is not None and linked.site == "imgur"
+        is_link_to_gfycat = linked is not None and linked.site == "gfycat"
         is_video = post_data.get("is_video", False)
         is_nsfw = post_data.get("over_18", False)
 
@@ -78,10 +196,10 @@ class RedditLoader(ContentLoader):
             return self.get_image(post_data, title, thumbnail, post_hint), metadata
 
         elif is_link_to_imgur:
-            return await self.get_imgur_content(post_data, title), metadata
+            return await self.get_imgur_content(post_data, linked, title), metadata
 
         elif is_link_to_gfycat:
-            return await self.get_gfycat_content(post_data, title), metadata
+            return await self.get_gfycat_content(post_data, linked, title), metadata
 
         # Video embeds
         elif post_hint == "rich:video":
@@ -98,7 +216,7 @@ class RedditLoader(ContentLoader):
         elif is_comment:
             comment_data = comments["data"]["children"][0]["data"]
 
-            metadata = RedditMetadata(url, post_data, comment_data)
+            metadata = RedditMetadata(post_data, comment_data)
 
             return Text(comment_data["body"], parse_mode="markdown"), metadata
 
@@ -111,10 +229,16 @@ class RedditLoader(ContentLoader):
         except (IndexError, KeyError):
             pass
 
-        if thumbnail:
-            thumbnail = thumbnail.replace("&amp;", "&")
+        video = post_data["secure_media"]["reddit_video"]
+        video_url = video["fallback_url"]
+        renditions = []
 
-        return Video(post_data["secure_media"]["reddit_video"]["fallback_url"], thumbnail, title)
+        # The lower rungs of the bitrate ladder
+        if re.search(r"DASH_\d+", video_url):
+            renditions = [re.sub(r"DASH_\d+", f"DASH_{height}", video_url)
+                          for height in VIDEO_HEIGHTS if height < video.get("height", 0)]
+
+        return Video(video_url, thumbnail, title, renditions=renditions)
 
     def get_gallery(self, post_data, title) -> Album:
         media = []
@@ -130,71 +254,80 @@ class RedditLoader(ContentLoader):
                 caption = item["caption"]
 
             if image["m"] in ("image/png", "image/jpg"):
-                media.append(Image(image["s"]["u"].replace("&amp;", "&"), None, caption))
+                media.append(Image(image["s"]["u"], None, caption,
+                                   renditions=_get_renditions(image.get("p", []), "u", "x")))
 
             elif image["m"] == "image/gif":
-                media.append(Animation(image["s"]["u"].replace("&amp;", "&"), None, caption))
+                media.append(Animation(image["s"]["u"], None, caption,
+                                       renditions=[image["s"]["mp4"]] if "mp4" in image["s"] else []))
 
         return Album(media, post_data["url"], title)
 
     def get_image(self, post_data, title, thumbnail, post_hint) -> Union[Image, Animation]:
         image_url = post_data["url"]
+        renditions = []
 
         is_gif = re.search(r"\.gif", image_url, re.I)
 
         if post_hint is not None and is_gif:
-            image_url = post_data["preview"]["images"][0]["variants"]["gif"]["source"]["url"]
+            variants = post_data["preview"]["images"][0]["variants"]
+            image_url = variants["gif"]["source"]["url"]
+
+            # The same animation as MP4 is a fraction of the size of the GIF
+            if "mp4" in variants:
+                renditions += [variants["mp4"]["source"]["url"], *_get_renditions(variants["mp4"]["resolutions"])]
+
+            renditions += _get_renditions(variants["gif"]["resolutions"])
 
         elif post_hint is not None:
             image_url = post_data["preview"]["images"][0]["source"]["url"]
+            renditions = _get_renditions(post_data["preview"]["images"][0]["resolutions"])
             try:
                 thumbnail = post_data["preview"]["images"][0]["resolutions"][0]["url"]
             except (IndexError, KeyError):
                 pass
 
-        image_url = image_url.replace("&amp;", "&")
-
-        if thumbnail:
-            thumbnail = thumbnail.replace("&amp;", "&")
-
         if is_gif:
-            return Animation(image_url, thumbnail, title)
+            return Animation(image_url, thumbnail, title, renditions=renditions)
 
         else:
-            return Image(image_url, thumbnail, title)
+            return Image(image_url, thumbnail, title, renditions=renditions)
 
-    async def get_gfycat_content(self, post_data, title):
+    async def get_gfycat_content(self, post_data, link: LinkDescriptor, title):
         try:
-            content, _ = await GfyCatLoader(parent=self).load(post_data['url'])
+            content, _ = await get_loader("gfycat")(parent=self).load_link(link)
 
-            content.caption = title
-            return content
+            return content.replace(caption=title)
 
-        except ClientError:
+        # The post is still worth a link when the media it links to is out of reach, for whatever reason
+        except (ClientError, MediaNotFoundError):
+            self._degraded = True
             return Link(post_data["url"], title, icon="🎬")
 
-    async def get_imgur_content(self, post_data, title):
+    async def get_imgur_content(self, post_data, link: LinkDescriptor, title):
         try:
-            content, _ = await ImgurLoader(parent=self).load(post_data['url'])
+            content, _ = await ImgurLoader(parent=self).load_link(link)
 
-            content.caption = title
-            return content
+            return content.replace(caption=title)
 
-        except ClientError:
+        # The post is still worth a link when the media it links to is out of reach, for whatever reason
+        except (ClientError, MediaNotFoundError):
+            self._degraded = True
             return Link(post_data["url"], title, icon="🖼")
 
 
 class RedditMetadata(Metadata):
-    comment_permalink = None
+    __slots__ = ("post_permalink", "sub", "sub_link", "author", "comment_permalink")
 
-    def __init__(self, url: str, post_data: Dict, comment_data: Dict = None):
-        self.post_permalink = repath_url(url, post_data["permalink"])
+    def __init__(self, post_data: Dict, comment_data: Dict = None):
+        self.post_permalink = repath_url(REDDIT_URL, post_data["permalink"])
         self.sub = post_data["subreddit_name_prefixed"]
-        self.sub_link = repath_url(url, self.sub)
+        self.sub_link = repath_url(REDDIT_URL, self.sub)
         self.author = "u/" + post_data["author"]
+        self.comment_permalink = None
         if comment_data:
             self.author = "u/" + comment_data["author"]
-            self.comment_permalink = repath_url(url, comment_data["permalink"])
+            self.comment_permalink = repath_url(REDDIT_URL, comment_data["permalink"])
 
     def get_buttons(self) -> List[Button]:
         buttons = []
@@ -210,4 +343,6 @@ class RedditMetadata(Metadata):
         return buttons
 
 
-__all__ = ["RedditLoader", "REDDIT_REGEXP"]
+register_loader(RedditLoader)
+
+__all__ = ["RedditLoader", "REDDIT_CACHE", "SHARE_CACHE"]
@@ -0,0 +1,56 @@
+from importlib import import_module
+from typing import Dict, List, Optional, Tuple, Type
+
+from url_utils import LinkDescriptor, register_host
+from .loader import ContentLoader
+
+LOADERS: Dict[str, Type[ContentLoader]] = {}
+
+# Modules of the loaders imported on their first use, by upstream
+_LAZY_LOADERS: Dict[str, str] = {}
+
+
+def register_loader(loader: Type[ContentLoader]) -> Type[ContentLoader]:
+    """
+    Makes the links to the hosts of the loader recognized, and routed to the loader
+    """
+    for host in loader.hosts:
+        register_host(host, loader.classify)
+
+    LOADERS[loader.upstream] = loader
+
+    return loader
+
+
+def register_lazy_loader(upstream: str, hosts: Tuple[str, ...], module: str) -> None:
+    """
+    Makes the links to the hosts recognized without importing the module of their loader until the first of them,
+    for the loaders that are rarely used
+    """
+    _LAZY_LOADERS[upstream] = module
+
+    def classify(url: str, path: List[str]) -> Optional[LinkDescriptor]:
+        return _import_loader(upstream).classify(url, path)
+
+    for host in hosts:
+        register_host(host, classify)
+
+
+def _import_loader(upstream: str) -> Type[ContentLoader]:
+    if upstream not in LOADERS:
+        # The module registers the loader itself, for its hosts as well
+        import_module(_LAZY_LOADERS[upstream], __package__)
+
+    return LOADERS[upstream]
+
+
+def get_loader(site: str) -> Optional[Type[ContentLoader]]:
+    loader = LOADERS.get(site)
+
+    if loader is None and site in _LAZY_LOADERS:
+        loader = _import_loader(site)
+
+    return loader
+
+
+__all__ = ["LOADERS", "register_loader", "register_lazy_loader", "get_loader"]
@@ -1,43 +1,129 @@
+import asyncio
 import logging
+import os
 import re
+from functools import partial
 from os import getenv
-from typing import Union
+from typing import TYPE_CHECKING, Union, Optional, Tuple, List, Dict
 
 from aiogram import Bot, Dispatcher, executor
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.types import Message, InlineQuery
-from aiohttp import ClientError
+from aiohttp import ClientError, ClientSession
 
-from loaders.loader import MediaNotFoundError
-from loaders.reddit import REDDIT_REGEXP, RedditLoader
+from content import Content, Metadata
+from loaders import MediaNotFoundError, RedditLoader, get_loader
+from loaders.reddit import REDDIT_API_URL_DEFAULT, REDDIT_API_URL_KEY
+from metrics import observe_startup, start_metrics_server, stop_metrics_server
+from ratelimit import INLINE_PRIORITY, MESSAGE_PRIORITY, prioritized
 from reply import Reply
-from url_utils import find_urls
+from scheduler import SCHEDULER
+from sessions import SESSIONS
+from tracing import trace
+from url_utils import LinkDescriptor, find_links, repath_url
+from webhook import is_webhook_enabled, start_webhook
 
+if TYPE_CHECKING:
+    from supervisor import UpdateQueue
 
-async def unreddit(trigger: Union[Message, InlineQuery]):
+MESSAGE_CONCURRENCY_DEFAULT = 4
+MESSAGE_CONCURRENCY_KEY = "MESSAGE_CONCURRENCY"
+GLOBAL_CONCURRENCY_DEFAULT = 32
+GLOBAL_CONCURRENCY_KEY = "GLOBAL_CONCURRENCY"
+WORKERS_DEFAULT = 1
+WORKERS_KEY = "WORKERS"
+
+# aiogram's own switch, honoured here as well
+DISABLE_UVLOOP_KEY = "DISABLE_UVLOOP"
+
+_global_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def _get_global_semaphore() -> asyncio.Semaphore:
+    global _global_semaphore
+
+    if _global_semaphore is None:
+        _global_semaphore = asyncio.Semaphore(int(getenv(GLOBAL_CONCURRENCY_KEY, GLOBAL_CONCURRENCY_DEFAULT)))
+
+    return _global_semaphore
+
+
+def _get_session(trigger: Union[Message, InlineQuery], upstream: str) -> ClientSession:
+    return SESSIONS.get(upstream) or trigger.bot.session
+
+
+def _get_text(trigger: Union[Message, InlineQuery]) -> Optional[str]:
     if isinstance(trigger, Message):
-        text = trigger.text
+        return trigger.text
 
     elif isinstance(trigger, InlineQuery):
-        text = trigger.query
+        return trigger.query
 
-    else:
-        return
+    return None
+
+
+def has_links(trigger: Union[Message, InlineQuery]) -> Union[bool, Dict[str, List[LinkDescriptor]]]:
+    """
+    Dispatcher filter, passing the found links on to the handler so that the text is scanned only once
+    """
+    links = find_links(_get_text(trigger))
+    return {"links": links} if links else False
+
+
+async def _load(trigger: Union[Message, InlineQuery], link: LinkDescriptor,
+                semaphore: asyncio.Semaphore) -> Optional[Tuple[Content, Metadata]]:
+    loader_type = get_loader(link.site)
+
+    if loader_type is None:
+        return None
 
-    for url in find_urls(text):
-        loader = RedditLoader(trigger.bot.session)
+    async with semaphore, _get_global_semaphore():
+        loader = loader_type(_get_session(trigger, loader_type.upstream))
 
         try:
-            attachment, metadata = await loader.load(url)
+            return await loader.load_link(link)
 
         except ClientError as e:
             logging.getLogger().error(e)
-            continue
 
         except MediaNotFoundError:
+            pass
+
+        except Exception as e:
+            logging.getLogger().exception(f"{link.url} has failed to load", exc_info=e)
+
+    return None
+
+
+async def unreddit(trigger: Union[Message, InlineQuery], links: Optional[List[LinkDescriptor]] = None):
+    if links is None:
+        links = find_links(_get_text(trigger))
+
+    priority = INLINE_PRIORITY if isinstance(trigger, InlineQuery) else MESSAGE_PRIORITY
+
+    with trace("update", trigger=type(trigger).__name__, links=len(links)), prioritized(priority):
+        await _reply(trigger, links)
+
+
+async def _reply(trigger: Union[Message, InlineQuery], links: List[LinkDescriptor]):
+    # Links are resolved concurrently, but the replies are sent in the order of the links
+    semaphore = asyncio.Semaphore(int(getenv(MESSAGE_CONCURRENCY_KEY, MESSAGE_CONCURRENCY_DEFAULT)))
+    loads = [asyncio.ensure_future(_load(trigger, link, semaphore)) for link in links]
+
+    for load in loads:
+        result = await load
+
+        if result is None:
             continue
 
-        reply = Reply(trigger, attachment, metadata)
-        await reply.send()
+        attachment, metadata = result
+
+        try:
+            reply = Reply(trigger, attachment, metadata)
+            await reply.send()
+
+        except Exception as e:
+            logging.getLogger().exception("Reply has failed to send", exc_info=e)
 
 
 async def unr(message: Message):
@@ -45,8 +131,9 @@ async def unr(message: Message):
 
     for sub in re.findall(r"r/\w+", message.text, re.I):
         try:
-            async with message.bot.session.get(f"https://www.reddit.com/{sub}.json",
-                                               allow_redirects=False) as response:
+            url = repath_url(getenv(REDDIT_API_URL_KEY, REDDIT_API_URL_DEFAULT), f"/{sub}.json")
+
+            async with _get_session(message, RedditLoader.upstream).get(url, allow_redirects=False) as response:
                 if response.status == 200:
                     data = await response.json()
 
@@ -62,23 +149,98 @@ async def unr(message: Message):
             return
 
     if links:
-        await message.reply("\n".join(links), parse_mode="markdown",
-                            disable_web_page_preview=True)
+        await SCHEDULER.submit(message.chat, partial(SCHEDULER.call, message.reply, "\n".join(links),
+                                                     parse_mode="markdown", disable_web_page_preview=True))
+
+
+class StartupMiddleware(BaseMiddleware):
+    """
+    Records the time to the first handled update
+    """
+
+    async def on_post_process_message(self, message: Message, results, data):
+        observe_startup("first_update")
+
+    async def on_post_process_inline_query(self, query: InlineQuery, results, data):
+        observe_startup("first_update")
+
+
+async def on_startup(dp: Dispatcher):
+    await SESSIONS.start()
+    await start_metrics_server()
+
+    observe_startup("ready")
+
+
+async def on_shutdown(dp: Dispatcher):
+    await stop_metrics_server()
+    await SESSIONS.close()
+
+
+def create_dispatcher(bot: Bot) -> Dispatcher:
+    dp = Dispatcher(bot)
+
+    dp.register_message_handler(unreddit, has_links)
+    dp.register_message_handler(unr, regexp=r"(^|\s+)r/\w+")
+
+    dp.register_inline_handler(unreddit, has_links)
+
+    dp.middleware.setup(StartupMiddleware())
+
+    return dp
+
+
+def install_uvloop() -> bool:
+    """
+    Makes the event loops created from then on uvloop ones, where it is installed
+    """
+    if DISABLE_UVLOOP_KEY in os.environ:
+        return False
+
+    try:
+        import uvloop
+
+    except ImportError:
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def run_worker(index: int, workers: int, updates: "UpdateQueue"):
+    from supervisor import configure_worker, serve
+
+    logging.basicConfig(level=logging.INFO, format=f"[worker-{index}] %(levelname)s:%(name)s:%(message)s")
+    install_uvloop()
+    configure_worker(index, workers)
+
+    dp = create_dispatcher(Bot(token=getenv("TELEGRAM_BOT_TOKEN")))
+    dp.loop.run_until_complete(serve(dp, updates, on_startup, on_shutdown))
 
 
 def main():
     logging.basicConfig(level=logging.INFO)
+    logging.getLogger().info(f"Event loop: {'uvloop' if install_uvloop() else 'asyncio'}")
 
+    # Created once the loop policy is set, as the bot takes its loop on creation
     bot = Bot(token=getenv("TELEGRAM_BOT_TOKEN"))
+    workers = int(getenv(WORKERS_KEY, WORKERS_DEFAULT))
 
-    dp = Dispatcher(bot)
+    if workers > 1:
+        from supervisor import ShardingDispatcher, Supervisor
 
-    dp.register_message_handler(unreddit, regexp=REDDIT_REGEXP)
-    dp.register_message_handler(unr, regexp=r"(^|\s+)r/\w+")
+        # The updates are received here and handled by the workers, each of them running the dispatcher of its own
+        supervisor = Supervisor(run_worker, workers)
+        dp, startup, shutdown = ShardingDispatcher(bot, supervisor), supervisor.on_startup, supervisor.on_shutdown
 
-    dp.register_inline_handler(unreddit)
+    else:
+        dp, startup, shutdown = create_dispatcher(bot), on_startup, on_shutdown
+
+    if is_webhook_enabled():
+        start_webhook(dp, on_startup=startup, on_shutdown=shutdown)
 
-    executor.start_polling(dp, skip_updates=True)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=startup, on_shutdown=shutdown)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,260 @@
+import bisect
+import logging
+import os
+import time
+from contextlib import contextmanager
+from os import getenv
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+from cache import LRUCache
+
+METRICS_HOST_DEFAULT = "127.0.0.1"
+METRICS_HOST_KEY = "METRICS_HOST"
+METRICS_PORT_KEY = "METRICS_PORT"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_metrics: List["Metric"] = []
+_caches: Dict[str, LRUCache] = {}
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+
+    if extra:
+        labels.append(extra)
+
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    type: str = None
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+
+        _metrics.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        return super().render() + [f"{self.name}{_format_labels(self.labels, key)} {value}"
+                                   for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+
+        try:
+            yield
+
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        entry = self.values.get(key)
+
+        if entry is None:
+            entry = self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+
+        counts, total = entry
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = perf_counter()
+
+        try:
+            yield
+
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                bucket = _format_labels(self.labels, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total[0]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+
+        return lines
+
+
+LOAD_SECONDS = Histogram("unreddit_load_seconds", "Time to resolve a link, by loader", ("loader",))
+PHASE_SECONDS = Histogram("unreddit_phase_seconds", "Time spent in a phase of resolving a link, by loader",
+                          ("loader", "phase"))
+SEND_SECONDS = Histogram("unreddit_send_seconds", "Time to send a reply to Telegram, by content type", ("content",))
+BATCH_SIZES = Histogram("unreddit_batch_size", "Keys loaded together by a batched call, by upstream", ("upstream",),
+                        (1, 2, 5, 10, 25, 50, 100))
+LOAD_RESULTS = Counter("unreddit_load_results_total", "Resolved links, by loader and result", ("loader", "result"))
+UPSTREAM_RESPONSES = Counter("unreddit_upstream_responses_total", "Upstream responses, by upstream and status code",
+                             ("upstream", "status"))
+SEND_FALLBACKS = Counter("unreddit_send_fallbacks_total",
+                         "Media Telegram has failed to embed and was sent as a link instead, by content type",
+                         ("content",))
+IN_FLIGHT_REQUESTS = Gauge("unreddit_in_flight_requests", "Upstream requests in progress, by upstream",
+                           ("upstream",))
+PREFLIGHT_RESULTS = Counter("unreddit_preflight_results_total",
+                            "Media checked before sending, by content type and the rendition picked",
+                            ("content", "result"))
+RELAYED_MEDIA = Counter("unreddit_relayed_media_total",
+                        "Media Telegram has failed to fetch, uploaded by the bot instead, by content type and result",
+                        ("content", "result"))
+QUEUED_SENDS = Gauge("unreddit_queued_sends", "Replies waiting for their turn to be sent to Telegram")
+RETRIED_SENDS = Counter("unreddit_retried_sends_total", "Calls to Telegram retried after hitting the flood control")
+STARTUP_SECONDS = Gauge("unreddit_startup_seconds",
+                        "Time from the start of the process to the bot being ready and to its first handled update",
+                        ("phase",))
+WORKER_RESTARTS = Counter("unreddit_worker_restarts_total", "Workers restarted by the supervisor after exiting")
+RATE_LIMITED_REQUESTS = Gauge("unreddit_rate_limited_requests",
+                              "Upstream requests waiting for the rate limit, by upstream", ("upstream",))
+
+
+def _get_started_at() -> float:
+    """
+    Moment the process has started on the perf_counter() clock, as told by Linux, or the moment of the import elsewhere
+    """
+    try:
+        with open("/proc/self/stat") as file:
+            # The fields following the name of the command, which may have spaces of its own
+            start_ticks = int(file.read().rpartition(")")[2].split()[19])
+
+        return perf_counter() - (time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf("SC_CLK_TCK"))
+
+    except (OSError, ValueError, IndexError, AttributeError):
+        return perf_counter()
+
+
+STARTED_AT = _get_started_at()
+
+
+def observe_startup(phase: str) -> None:
+    """
+    Records the time the process has taken to get to the phase of its startup, the first time it gets there
+    """
+    if STARTUP_SECONDS.get(phase=phase):
+        return
+
+    elapsed = perf_counter() - STARTED_AT
+    STARTUP_SECONDS.inc(elapsed, phase=phase)
+
+    logging.getLogger().info(f"Startup: {phase} after {elapsed:.3f}s")
+
+
+def register_cache(name: str, cache: LRUCache) -> None:
+    _caches[name] = cache
+
+
+def _render_caches() -> List[str]:
+    lines = []
+
+    for stat, kind in (("size", "gauge"), ("hits", "counter"), ("stale_hits", "counter"), ("misses", "counter"),
+                       ("evictions", "counter")):
+        name = f"unreddit_cache_{stat}" + ("_total" if kind == "counter" else "")
+        lines += [f"# HELP {name} Cache {stat.replace('_', ' ')}, by cache", f"# TYPE {name} {kind}"]
+        lines += [f'{name}{{cache="{cache_name}"}} {cache.stats[stat]}' for cache_name, cache in _caches.items()]
+
+    return lines
+
+
+def render() -> str:
+    lines = []
+
+    for metric in _metrics:
+        lines += metric.render()
+
+    lines += _render_caches()
+
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+_runner: Optional[web.AppRunner] = None
+
+
+async def start_metrics_server() -> None:
+    global _runner
+
+    if not getenv(METRICS_PORT_KEY) or _runner is not None:
+        return
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+
+    site = web.TCPSite(_runner, getenv(METRICS_HOST_KEY, METRICS_HOST_DEFAULT), int(getenv(METRICS_PORT_KEY)))
+    await site.start()
+
+    logging.getLogger().info(f"Serving metrics on {site.name}/metrics")
+
+
+async def stop_metrics_server() -> None:
+    global _runner
+
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
+
+
+__all__ = [
+    "Counter", "Gauge", "Histogram",
+    "LOAD_SECONDS", "PHASE_SECONDS", "SEND_SECONDS", "LOAD_RESULTS", "UPSTREAM_RESPONSES", "SEND_FALLBACKS",
+    "IN_FLIGHT_REQUESTS",
+    "register_cache", "render", "start_metrics_server", "stop_metrics_server"
+]
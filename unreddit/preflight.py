@@ -0,0 +1,147 @@
+import asyncio
+import logging
+from os import getenv
+from typing import Optional, Tuple
+
+from aiohttp import ClientError, ClientSession, ClientTimeout
+
+from cache import LRUCache
+from content import Album, Animation, Content, Image, Media, Text, Video
+from metrics import PREFLIGHT_RESULTS, register_cache
+from tracing import span
+
+PREFLIGHT_KEY = "PREFLIGHT"
+PREFLIGHT_CACHE_SIZE_DEFAULT = 4096
+PREFLIGHT_CACHE_SIZE_KEY = "PREFLIGHT_CACHE_SIZE"
+PREFLIGHT_CACHE_TTL_DEFAULT = 3600
+PREFLIGHT_CACHE_TTL_KEY = "PREFLIGHT_CACHE_TTL"
+PREFLIGHT_ERROR_CACHE_TTL_DEFAULT = 30
+PREFLIGHT_ERROR_CACHE_TTL_KEY = "PREFLIGHT_ERROR_CACHE_TTL"
+PREFLIGHT_CONCURRENCY_DEFAULT = 16
+PREFLIGHT_CONCURRENCY_KEY = "PREFLIGHT_CONCURRENCY"
+PREFLIGHT_TIMEOUT_DEFAULT = 3.0
+PREFLIGHT_TIMEOUT_KEY = "PREFLIGHT_TIMEOUT"
+
+# Largest files Telegram downloads by URL itself
+PHOTO_SIZE_LIMIT = 5 * 1024 * 1024
+FILE_SIZE_LIMIT = 20 * 1024 * 1024
+
+CONTENT_TYPES = {
+    Image: ("image/jpeg", "image/jpg", "image/pjpeg", "image/png", "image/webp", "image/gif", "image/bmp"),
+    Animation: ("image/gif", "video/mp4"),
+    Video: ("video/mp4",),
+}
+
+# Types that tell nothing of the media, which is given the benefit of the doubt
+UNKNOWN_CONTENT_TYPES = ("application/octet-stream", "binary/octet-stream")
+
+# Status, size and type of the checked media URLs
+PREFLIGHT_CACHE = LRUCache(int(getenv(PREFLIGHT_CACHE_SIZE_KEY, PREFLIGHT_CACHE_SIZE_DEFAULT)),
+                           float(getenv(PREFLIGHT_CACHE_TTL_KEY, PREFLIGHT_CACHE_TTL_DEFAULT)))
+
+register_cache("preflight", PREFLIGHT_CACHE)
+
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def is_preflight_enabled() -> bool:
+    return getenv(PREFLIGHT_KEY, "").lower() in ("1", "true", "yes")
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(int(getenv(PREFLIGHT_CONCURRENCY_KEY, PREFLIGHT_CONCURRENCY_DEFAULT)))
+
+    return _semaphore
+
+
+async def preflight(content: Content, session: ClientSession) -> Content:
+    """
+    Picks the best rendition of the media that Telegram is able to fetch by URL, checking all of them at once.
+    When none of them fits, the media is replaced with its link right away, instead of after a failed send
+    """
+    if not isinstance(content, Media):
+        return content
+
+    with span("preflight", content=type(content).__name__):
+        if isinstance(content, Album):
+            picked = await asyncio.gather(*(_pick(media, session) for media in content.payload))
+            fitting = tuple(media for media in picked if media is not None)
+
+            for media, fit in zip(content.payload, picked):
+                if fit is None:
+                    PREFLIGHT_RESULTS.inc(content=type(media).__name__, result="dropped")
+
+            # Telegram only takes albums of two items and more
+            if len(fitting) == 1:
+                return fitting[0].replace(caption=content.caption)
+
+            if fitting:
+                return content if fitting == content.payload else content.replace(payload=fitting)
+
+        else:
+            picked = await _pick(content, session)
+
+            if picked is not None:
+                return picked
+
+    PREFLIGHT_RESULTS.inc(content=type(content).__name__, result="fallback")
+    logging.getLogger().warning(f"{type(content)} {content.fallback} has no rendition Telegram can embed")
+
+    return Text(content.get_embed_fallback_message(), parse_mode="html")
+
+
+async def _pick(media: Media, session: ClientSession) -> Optional[Media]:
+    candidates = (media.payload, *media.renditions)
+    fits = await asyncio.gather(*(_fits(url, type(media), session) for url in candidates))
+
+    for url, fit in zip(candidates, fits):
+        if fit:
+            PREFLIGHT_RESULTS.inc(content=type(media).__name__,
+                                  result="original" if url == media.payload else "rendition")
+
+            return media if url == media.payload else media.replace(payload=url)
+
+    return None
+
+
+async def _fits(url: str, media_type: type, session: ClientSession) -> bool:
+    checked = PREFLIGHT_CACHE.get(url)
+
+    if checked is None:
+        checked = await _check(url, session)
+
+        # A failed check says little about the media itself, and is soon made again
+        PREFLIGHT_CACHE.put(url, checked, float(getenv(PREFLIGHT_ERROR_CACHE_TTL_KEY, PREFLIGHT_ERROR_CACHE_TTL_DEFAULT))
+                            if checked[0] == 0 else None)
+
+    status, size, content_type = checked
+    size_limit = PHOTO_SIZE_LIMIT if media_type is Image else FILE_SIZE_LIMIT
+
+    # Whatever the upstream does not tell is given the benefit of the doubt
+    return 200 <= status < 300 and \
+        (size is None or size <= size_limit) and \
+        (content_type is None or content_type in UNKNOWN_CONTENT_TYPES or
+         content_type in CONTENT_TYPES.get(media_type, (content_type,)))
+
+
+async def _check(url: str, session: ClientSession) -> Tuple[int, Optional[int], Optional[str]]:
+    timeout = ClientTimeout(total=float(getenv(PREFLIGHT_TIMEOUT_KEY, PREFLIGHT_TIMEOUT_DEFAULT)))
+
+    async with _get_semaphore():
+        try:
+            async with session.head(url, allow_redirects=True, timeout=timeout) as response:
+                length = response.headers.get("Content-Length", "")
+                content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+
+                return response.status, int(length) if length.isdigit() else None, content_type or None
+
+        except (ClientError, asyncio.TimeoutError) as e:
+            logging.getLogger().warning(f"Media {url} has failed to check: {e!r}")
+
+            return 0, None, None
+
+
+__all__ = ["PREFLIGHT_CACHE", "is_preflight_enabled", "preflight"]
@@ -0,0 +1,207 @@
+import asyncio
+import heapq
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import getenv
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from metrics import RATE_LIMITED_REQUESTS
+from tracing import span
+
+RATE_LIMIT_BURST_DEFAULT = 10
+RATE_LIMIT_BURST_KEY = "RATE_LIMIT_BURST"
+RATE_LIMIT_RETRIES_DEFAULT = 3
+RATE_LIMIT_RETRIES_KEY = "RATE_LIMIT_RETRIES"
+RATE_LIMIT_SHARE_DEFAULT = 1.0
+RATE_LIMIT_SHARE_KEY = "RATE_LIMIT_SHARE"
+
+REMAINING_HEADER = "X-Ratelimit-Remaining"
+RESET_HEADER = "X-Ratelimit-Reset"
+RETRY_AFTER_HEADER = "Retry-After"
+RETRY_AFTER_DEFAULT = 1.0
+
+# Requests of a lower priority are served first once the budget is exhausted
+INLINE_PRIORITY = 0
+MESSAGE_PRIORITY = 1
+REVALIDATION_PRIORITY = 2
+
+_priority: ContextVar[int] = ContextVar("priority", default=MESSAGE_PRIORITY)
+
+
+def get_priority() -> int:
+    """
+    Priority of the upstream requests made in the current context, the lower the sooner
+    """
+    return _priority.get()
+
+
+@contextmanager
+def prioritized(priority: int):
+    """
+    Sets the priority of the upstream requests made within the enclosed block
+    """
+    token = _priority.set(priority)
+
+    try:
+        yield
+
+    finally:
+        _priority.reset(token)
+
+
+def _parse(headers: Mapping[str, str], name: str) -> Optional[float]:
+    try:
+        return float(headers[name])
+
+    except (KeyError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """
+    Token bucket refilled at the rate the upstream allows, as learned from its rate limit headers:
+    the remaining requests spread over the time until the limit resets. Unlimited until the upstream tells otherwise.
+    Requests over the budget wait in a queue, served by priority and then newest first,
+    as the older ones are the likeliest to be too late anyway.
+    Where the budget is shared with other processes, only the given share of it is spent
+    """
+
+    def __init__(self, upstream: str, burst: int, share: float = 1.0):
+        self.upstream = upstream
+        self.burst = burst
+        self.share = share
+
+        self.rate: Optional[float] = None
+        self.tokens = float(burst)
+        self.blocked_until = 0.0
+
+        self.__updated_at = 0.0
+        self.__waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self.__sequence = itertools.count()
+        self.__wakeup: Optional[asyncio.TimerHandle] = None
+
+    def __len__(self) -> int:
+        return sum(1 for *_, waiter in self.__waiters if not waiter.done())
+
+    async def acquire(self) -> None:
+        if not self.__waiters and self.__take():
+            return
+
+        waiter = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.__waiters, (_priority.get(), -next(self.__sequence), waiter))
+
+        with RATE_LIMITED_REQUESTS.track(upstream=self.upstream), span("rate_limit", upstream=self.upstream):
+            self.__dispatch()
+
+            try:
+                await waiter
+
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # The token has been taken for a request that is not going to be made
+                    self.tokens += 1
+                    self.__dispatch()
+
+                raise
+
+    def update(self, status: int, headers: Mapping[str, str]) -> None:
+        """
+        Learns the budget from the headers of a response
+        """
+        now = asyncio.get_event_loop().time()
+        remaining = _parse(headers, REMAINING_HEADER)
+        reset = _parse(headers, RESET_HEADER)
+
+        if status == 429:
+            retry_after = _parse(headers, RETRY_AFTER_HEADER) or reset or RETRY_AFTER_DEFAULT
+            self.__block(now + retry_after)
+
+        elif remaining is not None and reset is not None:
+            self.__refill(now)
+
+            if remaining < 1:
+                self.__block(now + reset)
+
+            else:
+                self.rate = remaining * self.share / max(reset, 1.0)
+                self.tokens = min(self.tokens, remaining * self.share)
+
+        self.__dispatch()
+
+    def __block(self, until: float) -> None:
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 0.0
+
+    def __refill(self, now: float) -> None:
+        if self.rate is not None:
+            elapsed = max(0.0, now - max(self.__updated_at, self.blocked_until))
+            self.tokens = min(float(self.burst), self.tokens + elapsed * self.rate)
+
+        self.__updated_at = now
+
+    def __take(self) -> bool:
+        now = asyncio.get_event_loop().time()
+
+        if now < self.blocked_until:
+            return False
+
+        if self.rate is None:
+            return True
+
+        self.__refill(now)
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+    def __get_delay(self) -> float:
+        now = asyncio.get_event_loop().time()
+
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        return (1 - self.tokens) / self.rate if self.rate else 0.0
+
+    def __dispatch(self) -> None:
+        if self.__wakeup is not None:
+            self.__wakeup.cancel()
+            self.__wakeup = None
+
+        while self.__waiters:
+            *_, waiter = self.__waiters[0]
+
+            if waiter.done():
+                heapq.heappop(self.__waiters)
+
+            elif self.__take():
+                heapq.heappop(self.__waiters)
+                waiter.set_result(None)
+
+            else:
+                self.__wakeup = asyncio.get_event_loop().call_later(self.__get_delay(), self.__dispatch)
+                break
+
+
+_limiters: Dict[str, RateLimiter] = {}
+
+
+def get_rate_limiter(upstream: str) -> RateLimiter:
+    limiter = _limiters.get(upstream)
+
+    if limiter is None:
+        limiter = _limiters[upstream] = RateLimiter(upstream,
+                                                    int(getenv(RATE_LIMIT_BURST_KEY, RATE_LIMIT_BURST_DEFAULT)),
+                                                    float(getenv(RATE_LIMIT_SHARE_KEY, RATE_LIMIT_SHARE_DEFAULT)))
+
+    return limiter
+
+
+def get_retries() -> int:
+    return int(getenv(RATE_LIMIT_RETRIES_KEY, RATE_LIMIT_RETRIES_DEFAULT))
+
+
+__all__ = ["INLINE_PRIORITY", "MESSAGE_PRIORITY", "REVALIDATION_PRIORITY", "RateLimiter", "get_priority",
+           "get_rate_limiter", "get_retries", "prioritized"]
@@ -0,0 +1,116 @@
+import asyncio
+import io
+import mimetypes
+import tempfile
+from contextlib import asynccontextmanager
+from os import getenv
+from pathlib import PurePosixPath
+from typing import AsyncIterator, BinaryIO, Optional, Tuple
+from urllib.parse import urlsplit
+
+from aiogram.types import InputFile
+from aiohttp import ClientSession
+
+from tracing import span
+
+RELAY_KEY = "RELAY"
+RELAY_CONCURRENCY_DEFAULT = 2
+RELAY_CONCURRENCY_KEY = "RELAY_CONCURRENCY"
+RELAY_SIZE_LIMIT_DEFAULT = 50 * 1024 * 1024
+RELAY_SIZE_LIMIT_KEY = "RELAY_SIZE_LIMIT"
+RELAY_SPOOL_SIZE_DEFAULT = 1024 * 1024
+RELAY_SPOOL_SIZE_KEY = "RELAY_SPOOL_SIZE"
+
+CHUNK_SIZE = 64 * 1024
+
+# Largest photo Telegram accepts as an upload, other files go up to the relay's own limit
+PHOTO_UPLOAD_LIMIT = 10 * 1024 * 1024
+
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+class RelayTooLargeError(Exception):
+    pass
+
+
+def is_relay_enabled() -> bool:
+    return getenv(RELAY_KEY, "").lower() in ("1", "true", "yes")
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(int(getenv(RELAY_CONCURRENCY_KEY, RELAY_CONCURRENCY_DEFAULT)))
+
+    return _semaphore
+
+
+@asynccontextmanager
+async def relay(url: str, session: ClientSession, size_limit: Optional[int] = None) -> AsyncIterator[InputFile]:
+    """
+    Downloads the media to upload it to Telegram, for the URLs Telegram is not able to fetch itself.
+    The download is kept in memory up to the spool size and in a temporary file past it, and is dropped on exit.
+    The relays are limited in number for as long as their uploads last as well
+    """
+    limit = int(getenv(RELAY_SIZE_LIMIT_KEY, RELAY_SIZE_LIMIT_DEFAULT))
+    limit = min(limit, size_limit) if size_limit is not None else limit
+
+    async with _get_semaphore():
+        with span("relay", url=url) as relay_span:
+            file, filename = await _download(url, session, limit)
+
+            if relay_span is not None:
+                relay_span.attributes["bytes"] = file.tell()
+
+        try:
+            file.seek(0)
+            yield InputFile(file, filename=filename)
+
+        finally:
+            file.close()
+
+
+async def _download(url: str, session: ClientSession, limit: int) -> Tuple[BinaryIO, str]:
+    spool_size = int(getenv(RELAY_SPOOL_SIZE_KEY, RELAY_SPOOL_SIZE_DEFAULT))
+
+    async with session.get(url) as response:
+        response.raise_for_status()
+
+        if response.content_length is not None and response.content_length > limit:
+            raise RelayTooLargeError(f"{url} is {response.content_length} bytes")
+
+        file: BinaryIO = io.BytesIO()
+
+        try:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                if file.tell() + len(chunk) > limit:
+                    raise RelayTooLargeError(f"{url} is over {limit} bytes")
+
+                if isinstance(file, io.BytesIO) and file.tell() + len(chunk) > spool_size:
+                    spilled = tempfile.TemporaryFile()
+                    spilled.write(file.getvalue())
+                    file.close()
+                    file = spilled
+
+                file.write(chunk)
+
+        except BaseException:
+            file.close()
+            raise
+
+        return file, _get_filename(url, response.content_type)
+
+
+def _get_filename(url: str, content_type: str) -> str:
+    path = PurePosixPath(urlsplit(url).path)
+    name = path.name or "media"
+
+    # Telegram tells the kind of the file by its extension
+    if not path.suffix:
+        name += mimetypes.guess_extension(content_type) or ""
+
+    return name
+
+
+__all__ = ["PHOTO_UPLOAD_LIMIT", "RelayTooLargeError", "is_relay_enabled", "relay"]
@@ -1,13 +1,32 @@
+import asyncio
 import hashlib
 import logging
-from typing import Union
+from functools import partial
+from os import getenv
+from typing import Union, Optional, List, Callable, Awaitable
 
-from aiogram.types import (Message, InlineQuery, InlineKeyboardMarkup, ContentType, InputMedia,
+from aiogram.types import (Message, InlineQuery, InlineKeyboardMarkup, ContentType, InputFile, InputMedia,
                            InlineQueryResultGif, InlineQueryResultPhoto, InlineQueryResultVideo, InlineKeyboardButton,
                            InlineQueryResult)
 from aiogram.utils.exceptions import BadRequest
+from aiohttp import ClientError
 
+from cache import LRUCache
 from content import *
+from metrics import RELAYED_MEDIA, SEND_FALLBACKS, SEND_SECONDS, register_cache
+from preflight import is_preflight_enabled, preflight
+from relay import PHOTO_UPLOAD_LIMIT, RelayTooLargeError, is_relay_enabled, relay
+from scheduler import SCHEDULER
+from sessions import SESSIONS
+from tracing import span
+
+FILE_ID_CACHE_SIZE_DEFAULT = 4096
+FILE_ID_CACHE_SIZE_KEY = "FILE_ID_CACHE_SIZE"
+
+# Telegram file_id of the media that has already been sent, keyed by the media URL
+FILE_ID_CACHE = LRUCache(int(getenv(FILE_ID_CACHE_SIZE_KEY, FILE_ID_CACHE_SIZE_DEFAULT)))
+
+register_cache("file_id", FILE_ID_CACHE)
 
 
 def _to_keyboard_markup(metadata: Metadata) -> InlineKeyboardMarkup:
@@ -29,11 +48,24 @@ class Reply:
         self.__metadata = metadata
 
     async def send(self):
-        if isinstance(self.__trigger, Message):
-            await _send_message(self.__trigger, self.__content, self.__metadata)
+        content_type = type(self.__content).__name__
+
+        with SEND_SECONDS.time(content=content_type), span("send", content=content_type):
+            if isinstance(self.__trigger, Message):
+                content = self.__content
+
+                if is_preflight_enabled() and not _is_uploaded(content):
+                    content = await preflight(content, SESSIONS.get("media") or self.__trigger.bot.session)
+
+                # The replies of a chat are sent in turn, an album going along with its caption.
+                # Telegram counts every item of an album as a message of its own
+                await SCHEDULER.submit(self.__trigger.chat,
+                                       partial(_send_message, self.__trigger, content, self.__metadata),
+                                       cost=len(content.payload) + 1 if isinstance(content, Album) else 1)
 
-        elif isinstance(self.__trigger, InlineQuery) and isinstance(self.__content, Media):
-            await _send_inline(self.__trigger, self.__content, self.__metadata)
+            # Inline queries are answered right away, as they have to be answered before they expire
+            elif isinstance(self.__trigger, InlineQuery) and isinstance(self.__content, Media):
+                await _send_inline(self.__trigger, self.__content, self.__metadata)
 
 
 async def _send_message(message: Message, content: Content, metadata: Metadata):
@@ -41,48 +73,156 @@ async def _send_message(message: Message, content: Content, metadata: Metadata):
 
     try:
         if isinstance(content, Text):
-            await message.reply(content.payload,
-                                parse_mode=content.parse_mode,
-                                reply_markup=reply_markup)
+            await SCHEDULER.call(message.reply, content.payload,
+                                 parse_mode=content.parse_mode,
+                                 reply_markup=reply_markup)
 
         elif isinstance(content, Image):
-            await message.reply_photo(content.payload,
-                                      caption=content.caption,
-                                      reply_markup=reply_markup)
+            await _send_media(message.reply_photo, content,
+                              caption=content.caption,
+                              reply_markup=reply_markup)
 
         elif isinstance(content, Video):
-            await message.reply_video(content.payload,
-                                      caption=content.caption,
-                                      reply_markup=reply_markup)
+            await _send_media(message.reply_video, content,
+                              caption=content.caption,
+                              reply_markup=reply_markup)
 
         elif isinstance(content, Animation):
-            await message.reply_animation(content.payload,
-                                          caption=content.caption,
-                                          reply_markup=reply_markup)
+            await _send_media(message.reply_animation, content,
+                              caption=content.caption,
+                              reply_markup=reply_markup)
 
         elif isinstance(content, Album):
-            album_messages = await message.reply_media_group([_to_input_media(m) for m in content.payload])
+            album_messages = await _send_album(message, content)
 
             # TODO: make it work
             # if album_messages:
             #     await album_messages[0].edit_reply_markup(buttons)
-            await album_messages[0].reply(content.caption,
-                                          reply_markup=reply_markup)
+            await SCHEDULER.call(album_messages[0].reply, content.caption,
+                                 reply_markup=reply_markup)
 
     except BadRequest as e:
         if not isinstance(content, Media):
             logging.getLogger().warning(f"Message {content.payload} "
                                         f"has failed to send: {e}")
 
-        else:
-            await message.reply(content.get_embed_fallback_message(),
-                                parse_mode="html",
-                                reply_markup=reply_markup)
+        elif not (is_relay_enabled() and not isinstance(content, Album)
+                  and await _send_relayed(message, content, reply_markup)):
+            SEND_FALLBACKS.inc(content=type(content).__name__)
+
+            await SCHEDULER.charge(message.chat)
+            await SCHEDULER.call(message.reply, content.get_embed_fallback_message(),
+                                 parse_mode="html",
+                                 reply_markup=reply_markup)
 
             logging.getLogger().warning(f"{type(content)} {content.fallback} "
                                         f"has failed to embed: {e}")
 
 
+def _get_file_id(message: Message) -> Optional[str]:
+    if message.photo:
+        return message.photo[-1].file_id
+
+    for file in (message.video, message.animation, message.document):
+        if file:
+            return file.file_id
+
+    return None
+
+
+def _is_uploaded(content: Content) -> bool:
+    if isinstance(content, Album):
+        return all(FILE_ID_CACHE.get(media.payload, count=False) for media in content.payload)
+
+    return isinstance(content, Media) and FILE_ID_CACHE.get(content.payload, count=False) is not None
+
+
+def _remember_file_id(media: Media, message: Message) -> None:
+    file_id = _get_file_id(message)
+
+    if file_id is not None:
+        FILE_ID_CACHE.put(media.payload, file_id)
+
+
+async def _send_media(send: Callable[..., Awaitable[Message]], media: Media, **kwargs) -> Message:
+    file_id = FILE_ID_CACHE.get(media.payload)
+
+    if file_id is not None:
+        try:
+            return await SCHEDULER.call(send, file_id, **kwargs)
+
+        except BadRequest as e:
+            FILE_ID_CACHE.pop(media.payload)
+
+            logging.getLogger().warning(f"Cached file {file_id} of {media.payload} "
+                                        f"has been rejected: {e}")
+
+    sent = await SCHEDULER.call(send, media.payload, **kwargs)
+    _remember_file_id(media, sent)
+
+    return sent
+
+
+async def _send_relayed(message: Message, media: Media, reply_markup: InlineKeyboardMarkup) -> bool:
+    if isinstance(media, Image):
+        send, size_limit = message.reply_photo, PHOTO_UPLOAD_LIMIT
+
+    elif isinstance(media, Video):
+        send, size_limit = message.reply_video, None
+
+    elif isinstance(media, Animation):
+        send, size_limit = message.reply_animation, None
+
+    else:
+        return False
+
+    try:
+        async with relay(media.payload, SESSIONS.get("media") or message.bot.session, size_limit) as file:
+            await SCHEDULER.charge(message.chat)
+            sent = await SCHEDULER.call(_upload, send, file, caption=media.caption, reply_markup=reply_markup)
+
+    except (RelayTooLargeError, ClientError, asyncio.TimeoutError, BadRequest) as e:
+        RELAYED_MEDIA.inc(content=type(media).__name__, result=type(e).__name__)
+        logging.getLogger().warning(f"{type(media)} {media.payload} has failed to relay: {e!r}")
+
+        return False
+
+    RELAYED_MEDIA.inc(content=type(media).__name__, result="ok")
+    _remember_file_id(media, sent)
+
+    return True
+
+
+async def _upload(send: Callable[..., Awaitable[Message]], file: InputFile, **kwargs) -> Message:
+    # A retried upload would start where the one before has left the file otherwise
+    file.file.seek(0)
+    return await send(file, **kwargs)
+
+
+async def _send_album(message: Message, album: Album) -> List[Message]:
+    file_ids = [FILE_ID_CACHE.get(media.payload) for media in album.payload]
+
+    if any(file_ids):
+        try:
+            return await SCHEDULER.call(message.reply_media_group, [_to_input_media(media, file_id)
+                                                                    for media, file_id in zip(album.payload, file_ids)])
+
+        except BadRequest as e:
+            for media in album.payload:
+                FILE_ID_CACHE.pop(media.payload)
+
+            logging.getLogger().warning(f"Cached files of {album.fallback} "
+                                        f"have been rejected: {e}")
+
+    album_messages = await SCHEDULER.call(message.reply_media_group,
+                                          [_to_input_media(media) for media in album.payload])
+
+    for media, sent in zip(album.payload, album_messages):
+        _remember_file_id(media, sent)
+
+    return album_messages
+
+
 async def _send_inline(query: InlineQuery, content: Media, metadata: Metadata):
     reply_markup = _to_keyboard_markup(metadata)
     results = []
@@ -145,10 +285,10 @@ def _to_query_result(media: Media, reply_markup: InlineKeyboardMarkup = None) ->
         raise ValueError()
 
 
-def _to_input_media(media: Media) -> InputMedia:
+def _to_input_media(media: Media, file_id: Optional[str] = None) -> InputMedia:
     if isinstance(media, Video):
         return InputMedia(
-            media=media.payload,
+            media=file_id or media.payload,
             thumb=media.thumbnail,
             caption=media.caption,
             type=ContentType.VIDEO
@@ -156,7 +296,7 @@ def _to_input_media(media: Media) -> InputMedia:
 
     elif isinstance(media, Image):
         return InputMedia(
-            media=media.payload,
+            media=file_id or media.payload,
             thumb=media.thumbnail,
             caption=media.caption,
             type=ContentType.PHOTO
@@ -164,7 +304,7 @@ def _to_input_media(media: Media) -> InputMedia:
 
     elif isinstance(media, Animation):
         return InputMedia(
-            media=media.payload,
+            media=file_id or media.payload,
             thumb=media.thumbnail,
             caption=media.caption,
             type=ContentType.ANIMATION
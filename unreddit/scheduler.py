@@ -0,0 +1,185 @@
+import asyncio
+import itertools
+import logging
+from os import getenv
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+from aiogram.types import Chat, ChatType
+from aiogram.utils.exceptions import RetryAfter
+
+from metrics import QUEUED_SENDS, RETRIED_SENDS
+from tracing import span
+
+SEND_RATE_DEFAULT = 30.0
+SEND_RATE_KEY = "SEND_RATE"
+SEND_BURST_DEFAULT = 10
+SEND_BURST_KEY = "SEND_BURST"
+CHAT_SEND_RATE_DEFAULT = 1.0
+CHAT_SEND_RATE_KEY = "CHAT_SEND_RATE"
+GROUP_SEND_RATE_DEFAULT = 20 / 60
+GROUP_SEND_RATE_KEY = "GROUP_SEND_RATE"
+CHAT_SEND_BURST_DEFAULT = 3
+CHAT_SEND_BURST_KEY = "CHAT_SEND_BURST"
+SEND_RETRIES_DEFAULT = 3
+SEND_RETRIES_KEY = "SEND_RETRIES"
+
+GROUP_CHAT_TYPES = (ChatType.GROUP, ChatType.SUPER_GROUP, ChatType.CHANNEL)
+
+T = TypeVar("T")
+
+
+class Pacer:
+    """
+    Spaces the sends out at the given rate, letting a burst of them through at once.
+    The sends are paced in the order they come in, their cost being the number of calls to Telegram they make
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.tolerance = max(0, burst - 1) * self.interval
+        self.ready_at = 0.0
+
+    async def wait(self, cost: int = 1) -> None:
+        now = asyncio.get_event_loop().time()
+        ready_at = max(self.ready_at, now)
+        self.ready_at = ready_at + cost * self.interval
+
+        delay = ready_at - self.tolerance - now
+
+        if delay > 0:
+            with span("pace", delay=delay):
+                await asyncio.sleep(delay)
+
+
+class _Chat:
+    __slots__ = ("lock", "pacer", "users")
+
+    def __init__(self, pacer: Pacer):
+        self.lock = asyncio.Lock()
+        self.pacer = pacer
+        self.users = 0
+
+
+_pacer: Optional[Pacer] = None
+
+
+def _get_pacer() -> Pacer:
+    global _pacer
+
+    if _pacer is None:
+        _pacer = Pacer(float(getenv(SEND_RATE_KEY, SEND_RATE_DEFAULT)), int(getenv(SEND_BURST_KEY, SEND_BURST_DEFAULT)))
+
+    return _pacer
+
+
+def _get_chat_pacer(chat: Chat) -> Pacer:
+    if chat.type in GROUP_CHAT_TYPES:
+        rate = float(getenv(GROUP_SEND_RATE_KEY, GROUP_SEND_RATE_DEFAULT))
+
+    else:
+        rate = float(getenv(CHAT_SEND_RATE_KEY, CHAT_SEND_RATE_DEFAULT))
+
+    return Pacer(rate, int(getenv(CHAT_SEND_BURST_KEY, CHAT_SEND_BURST_DEFAULT)))
+
+
+class SendScheduler:
+    """
+    Queues the replies of every chat to send them one unit at a time, in order, at the pace Telegram allows
+    in the chat and for the bot as a whole. A unit is everything a reply sends, such as an album and its caption,
+    so that the replies to different links are not interleaved.
+    Flood control only holds up the chat it has been imposed on, while the other chats keep being served
+    """
+
+    def __init__(self):
+        self.__chats: Dict[int, _Chat] = {}
+
+    def __len__(self) -> int:
+        return len(self.__chats)
+
+    async def submit(self, chat: Chat, unit: Callable[[], Awaitable[T]], cost: int = 1) -> T:
+        lane = self.__chats.get(chat.id)
+
+        if lane is None:
+            lane = self.__chats[chat.id] = _Chat(_get_chat_pacer(chat))
+
+        lane.users += 1
+
+        try:
+            await self.__wait_turn(lane, cost)
+
+            try:
+                return await unit()
+
+            finally:
+                lane.lock.release()
+
+        finally:
+            lane.users -= 1
+
+            if not lane.users:
+                self.__release(chat.id, lane)
+
+    async def charge(self, chat: Chat, cost: int = 1) -> None:
+        """
+        Paces the sends a unit makes beyond the cost it has been submitted with, such as the fallback of a failed one
+        """
+        lane = self.__chats.get(chat.id)
+
+        if lane is not None:
+            await lane.pacer.wait(cost)
+
+        await _get_pacer().wait(cost)
+
+    async def call(self, send: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+        """
+        Makes a call to Telegram, waiting out the flood control as many times as allowed.
+        Within a unit the wait holds up the chat of the unit only
+        """
+        retries = int(getenv(SEND_RETRIES_KEY, SEND_RETRIES_DEFAULT))
+
+        for attempt in itertools.count():
+            try:
+                return await send(*args, **kwargs)
+
+            except RetryAfter as e:
+                if attempt >= retries:
+                    raise
+
+                RETRIED_SENDS.inc()
+                logging.getLogger().warning(f"Send has hit the flood control, retrying in {e.timeout} seconds")
+
+                await asyncio.sleep(e.timeout)
+                await _get_pacer().wait()
+
+    @staticmethod
+    async def __wait_turn(lane: _Chat, cost: int) -> None:
+        with QUEUED_SENDS.track():
+            await lane.lock.acquire()
+
+            try:
+                # The chat's own pace goes first, so that the others are not held up while the chat waits for it
+                await lane.pacer.wait(cost)
+                await _get_pacer().wait(cost)
+
+            except BaseException:
+                lane.lock.release()
+                raise
+
+    def __release(self, chat_id: int, lane: _Chat) -> None:
+        # The chat is forgotten once it has caught up with its pace, as it would start afresh anyway
+        delay = lane.pacer.ready_at - asyncio.get_event_loop().time()
+
+        if delay > 0:
+            asyncio.get_event_loop().call_later(delay, self.__forget, chat_id, lane)
+
+        else:
+            self.__forget(chat_id, lane)
+
+    def __forget(self, chat_id: int, lane: _Chat) -> None:
+        if not lane.users and self.__chats.get(chat_id) is lane:
+            del self.__chats[chat_id]
+
+
+SCHEDULER = SendScheduler()
+
+__all__ = ["Pacer", "SCHEDULER", "SendScheduler"]
@@ -0,0 +1,71 @@
+from os import getenv
+from typing import Dict, Optional
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+POOL_SIZE_KEY = "{}_POOL_SIZE"
+KEEPALIVE_TIMEOUT_KEY = "{}_KEEPALIVE_TIMEOUT"
+DNS_CACHE_TTL_KEY = "{}_DNS_CACHE_TTL"
+CONNECT_TIMEOUT_KEY = "{}_CONNECT_TIMEOUT"
+READ_TIMEOUT_KEY = "{}_READ_TIMEOUT"
+
+
+class Upstream:
+    def __init__(self, name: str, pool_size: int, keepalive_timeout: float = 30.0, dns_cache_ttl: int = 300,
+                 connect_timeout: float = 5.0, read_timeout: float = 15.0):
+        self.name = name
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def _get(self, key: str, default):
+        return type(default)(getenv(key.format(self.name.upper()), default))
+
+    def create_session(self) -> ClientSession:
+        connector = TCPConnector(limit=self._get(POOL_SIZE_KEY, self.pool_size),
+                                 keepalive_timeout=self._get(KEEPALIVE_TIMEOUT_KEY, self.keepalive_timeout),
+                                 ttl_dns_cache=self._get(DNS_CACHE_TTL_KEY, self.dns_cache_ttl))
+
+        timeout = ClientTimeout(sock_connect=self._get(CONNECT_TIMEOUT_KEY, self.connect_timeout),
+                                sock_read=self._get(READ_TIMEOUT_KEY, self.read_timeout))
+
+        return ClientSession(connector=connector, timeout=timeout)
+
+
+UPSTREAMS = [
+    Upstream("reddit", pool_size=64),
+    Upstream("imgur", pool_size=16),
+    Upstream("gfycat", pool_size=8),
+    # Hosts of the media files, checked before they are sent
+    Upstream("media", pool_size=32),
+]
+
+
+class SessionPool:
+    """
+    Dedicated connection pool for each upstream, so that a slow upstream can't starve the others
+    """
+
+    def __init__(self):
+        self.__sessions: Dict[str, ClientSession] = {}
+
+    def get(self, upstream: str) -> Optional[ClientSession]:
+        return self.__sessions.get(upstream)
+
+    async def start(self) -> None:
+        for upstream in UPSTREAMS:
+            if upstream.name not in self.__sessions:
+                self.__sessions[upstream.name] = upstream.create_session()
+
+    async def close(self) -> None:
+        sessions, self.__sessions = self.__sessions, {}
+
+        for session in sessions.values():
+            await session.close()
+
+
+SESSIONS = SessionPool()
+
+__all__ = ["SESSIONS", "SessionPool", "Upstream", "UPSTREAMS"]
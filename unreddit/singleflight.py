@@ -0,0 +1,39 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls with the same key: all the callers await a single shared call.
+    Neither the result nor the error is kept once the call is done
+    """
+
+    def __init__(self):
+        self.__calls: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self.__calls)
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[T]]) -> T:
+        future = self.__calls.get(key)
+
+        if future is None:
+            future = asyncio.ensure_future(call())
+            future.add_done_callback(lambda done: self.__forget(key, done))
+
+            self.__calls[key] = future
+
+        # A cancelled caller must not cancel the call for the others
+        return await asyncio.shield(future)
+
+    def __forget(self, key: Hashable, future: asyncio.Future) -> None:
+        if self.__calls.get(key) is future:
+            del self.__calls[key]
+
+        if not future.cancelled():
+            future.exception()  # the error is delivered to the waiters, if there are any left
+
+
+__all__ = ["SingleFlight"]
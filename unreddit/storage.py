@@ -0,0 +1,124 @@
+import sqlite3
+from time import time
+from typing import Dict, Optional
+
+EVICTION_INTERVAL = 128
+
+# Lookups are made from the event loop, which is not to be held up for long by the other workers' writes
+BUSY_TIMEOUT_MS = 100
+
+
+class SqliteStore:
+    """
+    Persistent string key-value table in a local SQLite database, with optional expiration and size limit.
+    Lookups are local and short, so they are made synchronously from the event loop.
+    Their access times are written along with the next write, or after a number of lookups,
+    so that the lookups do not contend for the database with the writes of the other processes.
+
+    The table is recreated whenever its schema version differs from the one it was written with
+    """
+
+    def __init__(self, path: str, table: str, version: int = 1,
+                 size: Optional[int] = None, ttl: Optional[float] = None):
+        self.__table = table
+        self.__size = size
+        self.__ttl = ttl
+        self.__writes = 0
+        self.__accessed: Dict[str, float] = {}
+        self.__connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS schema_versions "
+                                  "(name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+
+        row = self.__connection.execute("SELECT version FROM schema_versions WHERE name = ?", (table,)).fetchone()
+
+        if row is None or row[0] != version:
+            self.__connection.execute(f"DROP TABLE IF EXISTS {table}")
+            self.__connection.execute("INSERT OR REPLACE INTO schema_versions (name, version) VALUES (?, ?)",
+                                      (table, version))
+
+        self.__connection.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                                  f"(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)")
+        self.__connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed_at ON {table} (accessed_at)")
+
+        # Set up with the default timeout, as all the workers create their tables at once on start
+        self.__connection.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+
+    def __len__(self) -> int:
+        return self.__connection.execute(f"SELECT COUNT(*) FROM {self.__table}").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.__connection.execute(f"SELECT value, expires_at FROM {self.__table} WHERE key = ?",
+                                        (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        value, expires_at = row
+        now = time()
+
+        if expires_at is not None and expires_at <= now:
+            self.__connection.execute(f"DELETE FROM {self.__table} WHERE key = ?", (key,))
+            return None
+
+        self.__accessed[key] = now
+
+        if len(self.__accessed) >= EVICTION_INTERVAL:
+            self.__write_accessed()
+
+        return value
+
+    def put(self, key: str, value: str) -> None:
+        now = time()
+        self.__accessed.pop(key, None)
+        self.__write_accessed()
+
+        self.__connection.execute(f"INSERT OR REPLACE INTO {self.__table} (key, value, expires_at, accessed_at) "
+                                  f"VALUES (?, ?, ?, ?)",
+                                  (key, value, now + self.__ttl if self.__ttl is not None else None, now))
+
+        self.__writes += 1
+
+        if self.__writes % EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def pop(self, key: str) -> None:
+        self.__accessed.pop(key, None)
+        self.__connection.execute(f"DELETE FROM {self.__table} WHERE key = ?", (key,))
+
+    def evict(self) -> None:
+        self.__connection.execute(f"DELETE FROM {self.__table} WHERE expires_at <= ?", (time(),))
+
+        if self.__size is not None:
+            self.__connection.execute(f"DELETE FROM {self.__table} WHERE key IN "
+                                      f"(SELECT key FROM {self.__table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                                      (self.__size,))
+
+    def close(self) -> None:
+        try:
+            self.__write_accessed()
+
+        finally:
+            self.__connection.close()
+
+    def __write_accessed(self) -> None:
+        if not self.__accessed:
+            return
+
+        accessed, self.__accessed = self.__accessed, {}
+
+        # In a single transaction rather than one for each of them
+        self.__connection.execute("BEGIN")
+
+        try:
+            self.__connection.executemany(f"UPDATE {self.__table} SET accessed_at = ? WHERE key = ?",
+                                          [(accessed_at, key) for key, accessed_at in accessed.items()])
+            self.__connection.execute("COMMIT")
+
+        except BaseException:
+            self.__connection.execute("ROLLBACK")
+            raise
+
+
+__all__ = ["SqliteStore"]
@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import os
+import signal
+import tempfile
+from collections import deque
+from multiprocessing import get_context
+from multiprocessing.context import BaseContext
+from multiprocessing.process import BaseProcess
+from os import getenv
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from loaders.loader import CONTENT_CACHE_PATH_KEY
+from loaders.reddit import SHARE_CACHE_PATH_KEY
+from metrics import METRICS_PORT_KEY, WORKER_RESTARTS, start_metrics_server, stop_metrics_server
+from ratelimit import RATE_LIMIT_SHARE_KEY
+from scheduler import SEND_BURST_DEFAULT, SEND_BURST_KEY, SEND_RATE_DEFAULT, SEND_RATE_KEY
+
+WORKER_CHECK_INTERVAL = 1.0
+WORKER_SHUTDOWN_TIMEOUT = 30
+
+# Shared by the workers when no path is set for the persistent caches
+SHARED_CACHE_FILE = "unreddit-cache.sqlite3"
+
+Callback = Callable[[Dispatcher], Any]
+Worker = Callable[[int, int, "UpdateQueue"], None]
+
+
+def get_shard(update: Dict, shards: int) -> int:
+    """
+    Worker of the update, picked by its chat, or by its user for the updates without one such as inline queries,
+    so that all the updates of a chat are handled by the same worker in the order they come in
+    """
+    for kind in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if kind in update:
+            return update[kind]["chat"]["id"] % shards
+
+    for kind, value in update.items():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"] % shards
+
+    return update["update_id"] % shards
+
+
+class UpdateQueue:
+    """
+    Updates routed to a worker. The worker counts the updates it has taken, so that the supervisor knows
+    which of them have never reached it and can hand them over to the next worker should this one die.
+    The count is kept in shared memory without a lock, as a killed worker would leave the lock held,
+    the way it leaves the lock of the queue held when it is killed waiting for an update
+    """
+
+    def __init__(self, context: BaseContext):
+        self.__queue = context.Queue()
+        self.__taken = context.RawValue("Q", 0)
+
+        # Supervisor's own, the updates that may not have been taken yet
+        self.__put = 0
+        self.__untaken: Deque[Dict] = deque()
+
+    def __getstate__(self):
+        return self.__queue, self.__taken
+
+    def __setstate__(self, state):
+        self.__queue, self.__taken = state
+        self.__put = 0
+        self.__untaken = deque()
+
+    def put(self, update: Dict) -> None:
+        self.__queue.put(update)
+        self.__put += 1
+        self.__untaken.append(update)
+        self.__forget_taken()
+
+    def get(self) -> Optional[Dict]:
+        update = self.__queue.get()
+
+        if update is not None:
+            self.__taken.value += 1
+
+        return update
+
+    def stop(self) -> None:
+        self.__queue.put(None)
+
+    def close(self) -> List[Dict]:
+        """
+        Closes the queue, returning the updates the worker has not taken
+        """
+        self.__forget_taken()
+
+        # The pipe may be full with no one left to read it, which must not hold up the exit
+        self.__queue.close()
+        self.__queue.cancel_join_thread()
+
+        return list(self.__untaken)
+
+    def __forget_taken(self) -> None:
+        while len(self.__untaken) > self.__put - self.__taken.value:
+            self.__untaken.popleft()
+
+
+class Supervisor:
+    """
+    Runs the bot in several processes, each of them handling the updates of its share of the chats.
+    The updates are received by the supervisor alone, so that the bot still has a single poller or webhook.
+    The workers share the persistent caches and split the rate limits between themselves,
+    and are restarted whenever they exit
+    """
+
+    def __init__(self, worker: Worker, workers: int):
+        self.__worker = worker
+        self.__context = get_context("spawn")
+        self.__queues: List[UpdateQueue] = [UpdateQueue(self.__context) for _ in range(workers)]
+        self.__processes: List[Optional[BaseProcess]] = [None] * workers
+        self.__watch: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.__processes)
+
+    def route(self, update: Dict) -> None:
+        self.__queues[get_shard(update, len(self.__queues))].put(update)
+
+    def start(self) -> None:
+        shared_cache_path = str(Path(tempfile.gettempdir()) / SHARED_CACHE_FILE)
+
+        for key in (CONTENT_CACHE_PATH_KEY, SHARE_CACHE_PATH_KEY):
+            os.environ.setdefault(key, shared_cache_path)
+
+        for index in range(len(self.__processes)):
+            self.__spawn(index)
+
+        self.__watch = asyncio.ensure_future(self.__watch_workers())
+
+    async def stop(self) -> None:
+        if self.__watch is not None:
+            self.__watch.cancel()
+            self.__watch = None
+
+        for queue in self.__queues:
+            queue.stop()
+
+        loop = asyncio.get_event_loop()
+
+        for index, process in enumerate(self.__processes):
+            await loop.run_in_executor(None, process.join, WORKER_SHUTDOWN_TIMEOUT)
+
+            if process.is_alive():
+                logging.getLogger().warning(f"Worker {index} has failed to stop in time")
+                process.terminate()
+
+    async def on_startup(self, dp: Dispatcher) -> None:
+        self.start()
+        await start_metrics_server()
+
+    async def on_shutdown(self, dp: Dispatcher) -> None:
+        await self.stop()
+        await stop_metrics_server()
+
+    def __spawn(self, index: int) -> None:
+        process = self.__context.Process(target=self.__worker, args=(index, len(self.__processes),
+                                                                     self.__queues[index]),
+                                         name=f"worker-{index}", daemon=True)
+        process.start()
+
+        self.__processes[index] = process
+
+    def __restart(self, index: int) -> None:
+        # The queue may have been left locked by the worker, the updates it has not taken are moved to a new one
+        queue, self.__queues[index] = self.__queues[index], UpdateQueue(self.__context)
+
+        for update in queue.close():
+            self.__queues[index].put(update)
+
+        self.__spawn(index)
+
+    async def __watch_workers(self) -> None:
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+
+            for index, process in enumerate(self.__processes):
+                if not process.is_alive():
+                    WORKER_RESTARTS.inc()
+                    logging.getLogger().error(f"Worker {index} has exited with {process.exitcode}, restarting")
+
+                    self.__restart(index)
+
+
+class ShardingDispatcher(Dispatcher):
+    """
+    Dispatcher of the supervisor, handing the updates over to the workers instead of handling them itself
+    """
+
+    def __init__(self, bot: Bot, supervisor: Supervisor):
+        super().__init__(bot)
+        self.supervisor = supervisor
+
+    async def process_update(self, update: Update):
+        self.supervisor.route(update.to_python())
+
+
+def configure_worker(index: int, workers: int) -> None:
+    """
+    Splits the limits of the bot as a whole between the workers, to be called in the worker before it starts
+    """
+    send_rate = float(getenv(SEND_RATE_KEY, SEND_RATE_DEFAULT))
+    send_burst = int(getenv(SEND_BURST_KEY, SEND_BURST_DEFAULT))
+
+    os.environ[SEND_RATE_KEY] = str(send_rate / workers)
+    os.environ[SEND_BURST_KEY] = str(max(1, send_burst // workers))
+    os.environ[RATE_LIMIT_SHARE_KEY] = str(1 / workers)
+
+    # Every worker serves its own metrics, on the ports following the one of the supervisor
+    if getenv(METRICS_PORT_KEY):
+        os.environ[METRICS_PORT_KEY] = str(int(getenv(METRICS_PORT_KEY)) + 1 + index)
+
+    # Interrupts are for the supervisor, which stops the workers in turn
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _on_update_processed(tasks: Set[asyncio.Task], task: asyncio.Task) -> None:
+    tasks.discard(task)
+
+    if not task.cancelled() and task.exception() is not None:
+        logging.getLogger().exception("Update has failed to process", exc_info=task.exception())
+
+
+async def serve(dp: Dispatcher, updates: UpdateQueue, on_startup: Callback, on_shutdown: Callback) -> None:
+    """
+    Handles the updates routed to the worker until the supervisor stops it
+    """
+    loop = asyncio.get_event_loop()
+    tasks: Set[asyncio.Task] = set()
+
+    Dispatcher.set_current(dp)
+    Bot.set_current(dp.bot)
+
+    await on_startup(dp)
+
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+
+            if data is None:
+                break
+
+            task = asyncio.ensure_future(dp.process_update(Update(**data)))
+            tasks.add(task)
+            task.add_done_callback(lambda done: _on_update_processed(tasks, done))
+
+        if tasks:
+            await asyncio.wait(tasks, timeout=WORKER_SHUTDOWN_TIMEOUT)
+
+    finally:
+        await on_shutdown(dp)
+        await dp.bot.close()
+
+
+__all__ = ["ShardingDispatcher", "Supervisor", "UpdateQueue", "configure_worker", "get_shard", "serve"]
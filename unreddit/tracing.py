@@ -0,0 +1,162 @@
+import itertools
+import logging
+import os
+import random
+import sys
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import getenv
+from time import perf_counter, time
+from typing import Any, Dict, List, Optional
+
+import ujson
+
+TRACE_FILE_KEY = "TRACE_FILE"
+TRACE_SAMPLE_RATE_DEFAULT = 0.0
+TRACE_SAMPLE_RATE_KEY = "TRACE_SAMPLE_RATE"
+TRACE_SLOW_THRESHOLD_DEFAULT = 5.0
+TRACE_SLOW_THRESHOLD_KEY = "TRACE_SLOW_THRESHOLD"
+
+_trace_ids = itertools.count(1)
+
+
+class Span:
+    __slots__ = ("trace", "parent", "name", "attributes", "start", "end")
+
+    def __init__(self, trace: "Trace", parent: Optional["Span"], name: str, attributes: Dict[str, Any]):
+        self.trace = trace
+        self.parent = parent
+        self.name = name
+        self.attributes = attributes
+        self.start = perf_counter()
+        self.end: Optional[float] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else perf_counter()) - self.start
+
+    @property
+    def depth(self) -> int:
+        return 0 if self.parent is None else self.parent.depth + 1
+
+
+class Trace:
+    __slots__ = ("id", "started_at", "spans")
+
+    def __init__(self):
+        self.id = next(_trace_ids)
+        self.started_at = time()
+        self.spans: List[Span] = []
+
+    @property
+    def root(self) -> Span:
+        return self.spans[0]
+
+    def to_trace_events(self) -> List[Dict[str, Any]]:
+        """
+        Spans in the Trace Event Format, understood by chrome://tracing and Perfetto
+        """
+        origin = self.root.start
+        pid = os.getpid()
+
+        return [{
+            "name": span.name,
+            "cat": "unreddit",
+            "ph": "X",
+            "ts": int((self.started_at + span.start - origin) * 1_000_000),
+            "dur": int(span.duration * 1_000_000),
+            "pid": pid,
+            "tid": self.id,
+            "args": span.attributes
+        } for span in self.spans]
+
+    def to_record(self) -> Dict[str, Any]:
+        origin = self.root.start
+
+        return {
+            "trace_id": self.id,
+            "duration_ms": round(self.root.duration * 1000, 1),
+            "spans": [{
+                "name": span.name,
+                "depth": span.depth,
+                "start_ms": round((span.start - origin) * 1000, 1),
+                "duration_ms": round(span.duration * 1000, 1),
+                **span.attributes
+            } for span in self.spans]
+        }
+
+
+_current: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Records the enclosed block as a part of the current trace. Does nothing outside of a trace
+    """
+    parent = _current.get()
+
+    if parent is None:
+        yield None
+        return
+
+    current = Span(parent.trace, parent, name, attributes)
+    parent.trace.spans.append(current)
+    token = _current.set(current)
+
+    try:
+        yield current
+
+    finally:
+        current.end = perf_counter()
+        _current.reset(token)
+
+
+@contextmanager
+def trace(name: str, **attributes):
+    """
+    Starts a new trace with the enclosed block as its root span.
+    Sampled traces are exported, and the ones slower than the threshold are logged along with all of their spans
+    """
+    current = Trace()
+    root = Span(current, None, name, attributes)
+    current.spans.append(root)
+    token = _current.set(root)
+
+    try:
+        yield root
+
+    finally:
+        root.end = perf_counter()
+        _current.reset(token)
+
+        _finish(current)
+
+
+def _finish(current: Trace) -> None:
+    if current.root.duration >= float(getenv(TRACE_SLOW_THRESHOLD_KEY, TRACE_SLOW_THRESHOLD_DEFAULT)):
+        logging.getLogger().warning(f"Slow update: {ujson.dumps(current.to_record(), ensure_ascii=False)}")
+
+    sample_rate = float(getenv(TRACE_SAMPLE_RATE_KEY, TRACE_SAMPLE_RATE_DEFAULT))
+
+    if sample_rate > 0 and random.random() < sample_rate:
+        _export(current)
+
+
+def _export(current: Trace) -> None:
+    line = ujson.dumps({"traceEvents": current.to_trace_events()}, ensure_ascii=False) + "\n"
+    path = getenv(TRACE_FILE_KEY, "-")
+
+    try:
+        if path == "-":
+            sys.stdout.write(line)
+
+        else:
+            with open(path, "a", encoding="utf-8") as file:
+                file.write(line)
+
+    except OSError as e:
+        logging.getLogger().error(f"Trace {current.id} has failed to export: {e}")
+
+
+__all__ = ["Span", "Trace", "span", "trace"]
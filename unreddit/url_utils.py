@@ -1,15 +1,68 @@
 import re
-from urllib.parse import urlsplit, urlunsplit
+from typing import Callable, Dict, List, NamedTuple, Optional
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
+URL_REGEXP = re.compile(r"https?://[$-_@.&+!*(),a-zA-Z0-9]+")
 
-def find_urls(text: str) -> str:
-    urls = re.findall(
-        "http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*(),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+",
-        text
-    )
 
-    for url in urls:
-        yield url
+class LinkDescriptor(NamedTuple):
+    url: str
+    site: str
+    kind: str
+    post_id: Optional[str] = None
+    comment_id: Optional[str] = None
+    share_token: Optional[str] = None
+
+
+# Classifies the link by its path parts, returning None for the links that can't be handled
+Classifier = Callable[[str, List[str]], Optional[LinkDescriptor]]
+
+_CLASSIFIERS: Dict[str, Classifier] = {}
+
+
+def register_host(host: str, classifier: Classifier) -> None:
+    """
+    Registers the classifier for the links to the host and to all of its subdomains
+    """
+    _CLASSIFIERS[host.lower()] = classifier
+
+
+def classify_url(url: str) -> Optional[LinkDescriptor]:
+    try:
+        _, netloc, path, *_ = urlsplit(url)
+
+    except ValueError:
+        return None
+
+    host = netloc.rpartition("@")[2].partition(":")[0].lower()
+
+    while host:
+        classifier = _CLASSIFIERS.get(host)
+
+        if classifier is not None:
+            return classifier(url, [part for part in path.split("/") if part])
+
+        _, _, host = host.partition(".")
+
+    return None
+
+
+def find_links(text: Optional[str]) -> List[LinkDescriptor]:
+    """
+    Single pass over the text, yielding the links that some loader can handle, in the order of appearance
+    """
+    if not text:
+        return []
+
+    links = []
+
+    for url in URL_REGEXP.findall(text):
+        link = classify_url(url)
+
+        if link is not None:
+            links.append(link)
+
+    return links
 
 
 def get_path(url: str) -> str:
@@ -19,3 +72,9 @@ def get_path(url: str) -> str:
 def repath_url(base_url: str, new_path: str) -> str:
     scheme, netloc, *_ = urlsplit(base_url)
     return f"{urlunsplit((scheme, netloc, new_path, None, None))}"
+
+
+def normalize_url(url: str) -> str:
+    scheme, netloc, path, query, _ = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+    return urlunsplit((scheme.lower(), netloc.lower(), path or "/", query, None))
@@ -0,0 +1,125 @@
+import asyncio
+import hmac
+import logging
+from os import getenv
+from typing import Set, Callable, Awaitable, Optional
+
+import ujson
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+WEBHOOK_URL_KEY = "WEBHOOK_URL"
+WEBHOOK_PATH_DEFAULT = "/webhook"
+WEBHOOK_PATH_KEY = "WEBHOOK_PATH"
+WEBHOOK_SECRET_KEY = "WEBHOOK_SECRET"
+WEBHOOK_HOST_DEFAULT = "0.0.0.0"
+WEBHOOK_HOST_KEY = "WEBHOOK_HOST"
+WEBHOOK_PORT_DEFAULT = 8080
+WEBHOOK_PORT_KEY = "WEBHOOK_PORT"
+WEBHOOK_SHUTDOWN_TIMEOUT = 30
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+DISPATCHER_KEY = "dispatcher"
+TASKS_KEY = "tasks"
+
+Callback = Callable[[Dispatcher], Awaitable[None]]
+
+
+def is_webhook_enabled() -> bool:
+    return bool(getenv(WEBHOOK_URL_KEY))
+
+
+async def handle_update(request: web.Request) -> web.Response:
+    secret = getenv(WEBHOOK_SECRET_KEY)
+
+    if secret and not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ""), secret):
+        raise web.HTTPForbidden()
+
+    dp: Dispatcher = request.app[DISPATCHER_KEY]
+    tasks: Set[asyncio.Task] = request.app[TASKS_KEY]
+
+    update = Update(**await request.json(loads=ujson.loads))
+
+    Dispatcher.set_current(dp)
+    Bot.set_current(dp.bot)
+
+    # Telegram only waits for the acknowledgement, the update is processed after the response
+    task = asyncio.ensure_future(dp.process_update(update))
+    tasks.add(task)
+    task.add_done_callback(lambda done: _on_update_processed(tasks, done))
+
+    return web.Response()
+
+
+def _on_update_processed(tasks: Set[asyncio.Task], task: asyncio.Task):
+    tasks.discard(task)
+
+    if not task.cancelled() and task.exception() is not None:
+        logging.getLogger().exception("Update has failed to process", exc_info=task.exception())
+
+
+async def _on_startup(app: web.Application):
+    dp: Dispatcher = app[DISPATCHER_KEY]
+
+    webhook = {
+        "url": getenv(WEBHOOK_URL_KEY).rstrip("/") + getenv(WEBHOOK_PATH_KEY, WEBHOOK_PATH_DEFAULT),
+        "drop_pending_updates": True
+    }
+
+    if getenv(WEBHOOK_SECRET_KEY):
+        webhook["secret_token"] = getenv(WEBHOOK_SECRET_KEY)
+
+    await dp.bot.request("setWebhook", webhook)
+
+
+async def _on_shutdown(app: web.Application):
+    dp: Dispatcher = app[DISPATCHER_KEY]
+    tasks: Set[asyncio.Task] = app[TASKS_KEY]
+
+    # The webhook itself is kept: other instances behind the same URL may still be serving it
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=WEBHOOK_SHUTDOWN_TIMEOUT)
+
+        for task in pending:
+            task.cancel()
+
+        if pending:
+            logging.getLogger().warning(f"{len(pending)} updates were cancelled on shutdown")
+
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    await dp.bot.close()
+
+
+def make_app(dp: Dispatcher, on_startup: Optional[Callback] = None,
+             on_shutdown: Optional[Callback] = None) -> web.Application:
+    app = web.Application()
+
+    app[DISPATCHER_KEY] = dp
+    app[TASKS_KEY] = set()
+
+    app.router.add_post(getenv(WEBHOOK_PATH_KEY, WEBHOOK_PATH_DEFAULT), handle_update)
+
+    if on_startup is not None:
+        app.on_startup.append(lambda _: on_startup(dp))
+
+    app.on_startup.append(_on_startup)
+    app.on_shutdown.append(_on_shutdown)
+
+    if on_shutdown is not None:
+        app.on_shutdown.append(lambda _: on_shutdown(dp))
+
+    return app
+
+
+def start_webhook(dp: Dispatcher, on_startup: Optional[Callback] = None,
+                  on_shutdown: Optional[Callback] = None):
+    web.run_app(make_app(dp, on_startup, on_shutdown),
+                host=getenv(WEBHOOK_HOST_KEY, WEBHOOK_HOST_DEFAULT),
+                port=int(getenv(WEBHOOK_PORT_KEY, WEBHOOK_PORT_DEFAULT)),
+                loop=dp.loop)
+
+
+__all__ = ["is_webhook_enabled", "make_app", "start_webhook"]